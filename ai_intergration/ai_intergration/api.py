@@ -2,15 +2,31 @@ import frappe
 import requests
 import json
 import re
+import time
 import openai
-from openai import OpenAI
 from datetime import datetime
 from io import BytesIO
-from docx import Document
-import pandas as pd
-from ollama import Client
-from frappe.utils.file_manager import save_file
-from frappe.utils import get_url
+from frappe.utils import get_url, sbool
+from ai_intergration.ai_intergration.prompts import build_system_prompt
+from ai_intergration.ai_intergration.context_sources import get_agent_context
+from ai_intergration.ai_intergration.tool_catalog import get_catalog
+from ai_intergration.ai_intergration.history import get_history_limits, load_history, log_prompt_stats
+from ai_intergration.ai_intergration.diagnostics import log_event
+from ai_intergration.ai_intergration.images import ingest_image
+from ai_intergration.ai_intergration.speech import synthesize_speech, transcribe_audio
+from ai_intergration.ai_intergration.reference_context import build_document_prompt
+from ai_intergration.ai_intergration.bulk_responses import start_bulk_response
+from ai_intergration.ai_intergration.message_store import get_message, is_chat_table_storage
+from ai_intergration.ai_intergration.turn_writer import TurnWriter, begin_turn, end_turn, get_turn_writer
+from ai_intergration.ai_intergration.usage import get_ollama_usage, get_openai_usage, record_usage, set_usage_context
+from ai_intergration.ai_intergration.streaming import ReplyStream, create_openai_response, read_ollama_stream
+from ai_intergration.ai_intergration.chat_jobs import deliver_chat_result, enqueue_chat_turn
+from ai_intergration.ai_intergration.llm_clients import (
+    get_http_session,
+    get_ollama_client,
+    get_openai_client,
+    get_request_timeout,
+)
 
 
 AI_SYSTEM_PROMPT = """
@@ -79,7 +95,7 @@ def get_models():
     settings = frappe.get_doc("Ai Settings", "Ai Settings")
     url = f"{settings.base_url}/tags"
 
-    response = requests.get(url)
+    response = get_http_session().get(url, timeout=get_request_timeout())
 
     if response.status_code == 200:
         models = []
@@ -96,61 +112,28 @@ def get_gpt_models():
     try:
         # cred_id = frappe.get_value("Client Credentials", {"user": frappe.session.user})
         # if cred_id:
-            creds = frappe.get_doc("Client Credentials", "Main")
-            api_key = creds.get_password("api_key")
+            models = []
+            ai_client = get_openai_client("Main")
+            response = ai_client.models.list()
 
-            if api_key:
-                models = []
-                ai_client = OpenAI(api_key=api_key)
-                response = ai_client.models.list()
+            for model in response.data:
+                models.append(model.id)
 
-                for model in response.data:
-                    models.append(model.id)
-
-                return models
+            return models
                 
     except Exception as e:
-        save_response_log(str(e), "001", "001", True)
+        log_event("models", e, "ERROR")
         
         frappe.throw("invalid credentials")
 
 
 def save_response_log(body, from_number, to_account, is_error=False):
-    log = frappe.new_doc("WhatsApp Logs")
-    log.from_number = from_number
-    log.to_number = to_account
-    log.method = "Sent"
-    log.timestamp = datetime.now()
-    log.body = body
-    log.is_error = is_error
-    log.save(ignore_permissions=True)
+    # Kept for integrations calling it; new code uses log_event
+    log_event("response", body, "ERROR" if is_error else "INFO", from_number, to_account)
 
 
 def get_ai_requests_types(source_template):
-    source_template = frappe.get_doc("Ai Data Source Template", source_template)
-    sources = source_template.data_source_table
-    strings = []
-    for s in sources:
-        src = frappe.get_doc("Ai Data Source", s.source)
-        
-        strings.append(f"""{{
-        "when": "{src.when.strip() if src.when else ""}",
-        "method": "{src.method.strip()}",
-        "url": "{src.get_full_url()}",
-        "body": {src.get_json_body()},
-        "auth_type": "{src.auth_type.strip() if src.auth_type else ""}",
-        "auth_token": "{src.auth_token.strip() if src.auth_token else ""}",
-        "instructions": "{src.instructions.strip() if src.instructions else ""}"
-    }}""")
-
-    requests = ",\n".join(strings)
-
-    save_response_log(
-        str(requests),
-        "-1-1-1-1-1",
-        "-1-1-1-1-1"
-    )
-    return requests
+    return get_catalog(source_template)["request_types"]
 
 
 def get_external_links(links_template):
@@ -179,37 +162,43 @@ def web_search(context, chat, links):
 
 
 def save_message(chat, role, content, message_text: str=None, image: dict=None, message_type="text", timestamp: datetime=datetime.now()):
-    message = frappe.new_doc("Ai Message")
-    message.chat = chat
-    message.type = message_type
-    message.role = role
-    message.content = content
-    message.message_text = message_text
-    message.timestamp = timestamp
-    message.insert(ignore_permissions=True)
+    writer = get_turn_writer() or TurnWriter()
+    message = writer.new_message(
+        chat=chat,
+        role=role,
+        content=content,
+        message_text=message_text,
+        message_type=message_type,
+        timestamp=timestamp,
+    )
 
     if image:
-        image_content = image.get("content")
-        image_name = image.get("name")
-
-        filedoc = save_file(
-            fname=image_name,
-            content=image_content.getvalue(),
-            dt="Ai Message",
-            dn=message.name,
-            is_private=0
+        # The name is generated up front, so the file is attached before the message is written
+        stored = ingest_image(
+            image.get("content"),
+            image.get("name"),
+            "Ai Chat" if writer.chat_table else "Ai Message",
+            message.chat if writer.chat_table else message.name,
         )
 
-        message.image = filedoc.file_url
-        message.save(ignore_permissions=True)
+        message.image = stored.file_url
+        message.vision_image = stored.vision_url
+
+    if writer is not get_turn_writer():
+        # Outside a turn: write it right away
+        writer.flush(commit=False)
 
     return message
 
 
-def confirm_response(message_id):
-    message = frappe.get_doc("Ai Message", message_id)
-    message.responded_to = 1
-    message.save(ignore_permissions=True)
+def confirm_response(message_id, metrics: dict=None):
+    values = {"responded_to": 1, **(metrics or {})}
+
+    writer = get_turn_writer()
+    if writer:
+        writer.set_value("Ai Message", message_id, values)
+    else:
+        frappe.db.set_value("Ai Messages Table" if is_chat_table_storage() else "Ai Message", message_id, values)
 
 
 @frappe.whitelist(allow_guest=True)
@@ -224,6 +213,8 @@ def ai_chat(
     timestamp: datetime=datetime.now(),
     stream=False,
     context=None,
+    run_async=False,
+    callback_url=None,
 ):
     try:
         if not isinstance(new_message, dict):
@@ -234,7 +225,8 @@ def ai_chat(
             context = frappe.get_doc("AI Agent", chat.context)
 
         is_live = chat.is_live
-        
+
+        begin_turn()
         user_message = save_message(
             chat=chat.name,
             role=new_message["role"],
@@ -245,189 +237,239 @@ def ai_chat(
             timestamp=timestamp,
         )
 
-        new_messages = []
-
         ## Add image to prompt
         if image:
-            image_url = f"{get_url()}{user_message.image}"
+            image_url = f"{get_url()}{user_message.vision_image or user_message.image}"
             text = new_message["content"]
             new_message["content"] = [
                 {"type": "input_text", "text": text},
                 {"type": "input_image", "image_url": image_url}
             ]
 
-        new_messages.append({
-            "role": user_message.role,
-            "message_text": user_message.message_text,
-            "content": user_message.content,
-        })
-        # chat.append(
-        #     "messages",
-        #     {
-        #         "role": user_message.role,
-        #         "message_text": user_message.message_text,
-        #         "content": user_message.content,
-        #     }
-        # )
-
         if is_live:
-            chat.save(ignore_permissions=True)
             confirm_response(user_message.name)
-            frappe.db.commit()
+            get_turn_writer().touch(chat.name)
+            end_turn()
             return {"is_live": is_live, "response": plain_text}
-        
-
-        messages = get_current_messages(chat_id, context)
-        messages.append(new_message)
-            
-        if context.override_model == 1:
-            ai_response = ask_gpt_ai(model, context, messages, to_account)
-        elif context.default_model == 1:
-            ai_response = ask_ollama_ai(model, messages, to_account)
-        else:
-            ai_response = ask_local_ai(model, messages, to_account)
 
-        role = ai_response.get("role")
-        content = ai_response.get("content")
-        content = content.replace("```json", "").replace("```", "")
-
-        data = json.loads(content)
-
-        ai_message = data.get("response")
-        ai_message_type = data.get("message_type", "text")
-        ai_message_file_link = data.get("file_link")
-        ai_message_caption = data.get("caption")
-
-
-        resp_message = save_message(
-            chat=chat,
-            role=role,
-            content=content,
-            message_text=ai_message,
-            timestamp=timestamp,
-        )
-
-        new_messages.append({
-            "role": resp_message.role,
-            "message_text": resp_message.message_text,
-            "content": resp_message.content,
-        })
-        # chat.append(
-        #     "messages",
-        #     {
-        #         "role": resp_message.role,
-        #         "message_text": resp_message.message_text,
-        #         "content": resp_message.content,
-        #     }
-        # )
-
-        response_type = data.get("type")
+        if sbool(run_async):
+            job_id, result_token = enqueue_chat_turn(
+                "ai_intergration.ai_intergration.api.run_chat_turn",
+                user_message.name,
+                model=model,
+                context_id=context.name,
+                new_message=new_message,
+                to_account=to_account,
+                timestamp=timestamp,
+                stream=stream,
+                # Guests may not make the server call arbitrary URLs; they poll
+                # get_chat_result with the returned result_token instead
+                callback_url=callback_url if frappe.session.user != "Guest" else None,
+            )
+            # The job is enqueued on commit, once the user message is written
+            end_turn()
+            return {"is_live": is_live, "queued": True, "job_id": job_id, "result_token": result_token}
 
-        extra_data = None
-        if response_type == "request" and context.integration == 1 and context.source_type == "Template":
-            ## I want to get data from API and then embed it in the system prmopt or
-            ## send a new hidden user message to the llm
+        return process_chat_turn(model, chat, context, user_message, new_message, to_account, timestamp, stream)
 
-            request_data = data.get("request")
+    except Exception as e:
+        # Keep what the turn wrote so far, as the request's own commit used to
+        end_turn(commit=False)
+        log_event("chat", e, "ERROR")
+        return None
 
-            if request_data:
-                method = request_data.get("method")
-                url = request_data.get("url")
-                body = request_data.get("body")
-                auth_type = request_data.get("auth_type")
-                auth_token = request_data.get("auth_token")
 
-                query_data = make_ai_request(method, url, body, auth_type, auth_token)
-                if query_data:
-                    messages.append({
-                        "role": "system",
-                        "content": str(query_data),
-                    })
+def run_chat_turn(
+    user_message_id,
+    model,
+    context_id,
+    new_message,
+    to_account=None,
+    timestamp: datetime=None,
+    stream=False,
+    callback_url=None,
+    result_token=None,
+):
+    """Background job for `ai_chat(run_async=True)`."""
+    user_message = get_message(user_message_id)
+    chat = frappe.get_doc("Ai Chat", user_message.chat)
+    context = frappe.get_doc("AI Agent", context_id)
 
-                    if context.override_model == 1:
-                        ai_response = ask_gpt_ai(model, context, messages, to_account)
-                    elif context.default_model == 1:
-                        ai_response = ask_ollama_ai(model, messages, to_account)
-                    else:
-                        ai_response = ask_local_ai(model, messages, to_account)
+    begin_turn()
+    try:
+        result = process_chat_turn(model, chat, context, user_message, new_message, to_account, timestamp, stream)
+    except Exception as e:
+        end_turn(commit=False)
+        log_event("chat", e, "ERROR")
+        result = None
 
-                    role = ai_response.get("role")
-                    content = ai_response.get("content")
+    deliver_chat_result(chat.name, user_message.name, result, callback_url, result_token)
+    frappe.db.commit()
 
-                    data = json.loads(content)
 
-                    ai_message = data.get("response")
+def process_chat_turn(model, chat, context, user_message, new_message, to_account, timestamp, stream=False):
+    set_usage_context(agent=context.name, chat=chat.name)
 
-                    message = save_message(
-                        chat=chat,
-                        role="system",
-                        content=str(query_data),
-                        message_text="",
-                        timestamp=timestamp,
-                    )
-
-                    new_messages.append({
-                        "role": message.role,
-                        "message_text": message.message_text,
-                        "content": message.content,
-                    })
-                    # chat.append(
-                    #     "messages",
-                    #     {
-                    #         "role": message.role,
-                    #         "message_text": message.message_text,
-                    #         "content": message.content,
-                    #     }
-                    # )
-
-                    message = save_message(
-                        chat=chat,
-                        role=role,
-                        content=content,
-                        message_text=ai_message,
-                        timestamp=timestamp,
-                    )
-
-                    new_messages.append({
-                        "role": message.role,
-                        "message_text": message.message_text,
-                        "content": message.content,
-                    })
-                    # chat.append(
-                    #     "messages",
-                    #     {
-                    #         "role": message.role,
-                    #         "message_text": message.message_text,
-                    #         "content": message.content,
-                    #     }
-                    # )
+    new_messages = [{
+        "message": user_message.name,
+        "role": user_message.role,
+        "message_text": user_message.message_text,
+        "content": user_message.content,
+    }]
 
-        if response_type == "answer" and context.integration == 1 and context.webhook_uri:
+    # v1 replies are JSON objects, and a "request" reply is followed by a second
+    # call: only the decoded result is published, once the turn is done
+    reply_stream = ReplyStream(chat.name, publish=sbool(stream), publish_deltas=False)
 
-            json_body = data.get("json_body")
-            extra_data = post_to_webhook(context, json_body)
+    # With "Chat Table" storage a queued turn's user message is already a chat row
+    messages = get_current_messages(chat.name, context, exclude=[user_message.name])
+    messages.append(new_message)
         
-        chat.reload()
-        for msg in new_messages:
-            chat.append(
-                "messages",
-                msg,
-            )
-        chat.save(ignore_permissions=True)
-        confirm_response(user_message.name)
-        frappe.db.commit()
-        
-        return {
-            "is_live": is_live,
-            "response": ai_message,
-            "message_type": ai_message_type,
-            "file_link": ai_message_file_link,
-            "caption": ai_message_caption,
-        }
+    if context.override_model == 1:
+        ai_response = ask_gpt_ai(model, context, messages, to_account, reply_stream)
+    elif context.default_model == 1:
+        ai_response = ask_ollama_ai(model, messages, to_account, reply_stream)
+    else:
+        ai_response = ask_local_ai(model, messages, to_account, reply_stream)
+
+    role = ai_response.get("role")
+    content = ai_response.get("content")
+    content = content.replace("```json", "").replace("```", "")
+
+    data = json.loads(content)
+
+    ai_message = data.get("response")
+    ai_message_type = data.get("message_type", "text")
+    ai_message_file_link = data.get("file_link")
+    ai_message_caption = data.get("caption")
+
+
+    resp_message = save_message(
+        chat=chat,
+        role=role,
+        content=content,
+        message_text=ai_message,
+        timestamp=timestamp,
+    )
+
+    new_messages.append({
+        "message": resp_message.name,
+        "role": resp_message.role,
+        "message_text": resp_message.message_text,
+        "content": resp_message.content,
+    })
+    # chat.append(
+    #     "messages",
+    #     {
+    #         "role": resp_message.role,
+    #         "message_text": resp_message.message_text,
+    #         "content": resp_message.content,
+    #     }
+    # )
+
+    response_type = data.get("type")
+
+    extra_data = None
+    if response_type == "request" and context.integration == 1 and context.source_type == "Template":
+        ## I want to get data from API and then embed it in the system prmopt or
+        ## send a new hidden user message to the llm
+
+        request_data = data.get("request")
+
+        if request_data:
+            method = request_data.get("method")
+            url = request_data.get("url")
+            body = request_data.get("body")
+            auth_type = request_data.get("auth_type")
+            auth_token = request_data.get("auth_token")
+
+            query_data = make_ai_request(method, url, body, auth_type, auth_token)
+            if query_data:
+                messages.append({
+                    "role": "system",
+                    "content": str(query_data),
+                })
+
+                if context.override_model == 1:
+                    ai_response = ask_gpt_ai(model, context, messages, to_account, reply_stream)
+                elif context.default_model == 1:
+                    ai_response = ask_ollama_ai(model, messages, to_account, reply_stream)
+                else:
+                    ai_response = ask_local_ai(model, messages, to_account, reply_stream)
+
+                role = ai_response.get("role")
+                content = ai_response.get("content")
+
+                data = json.loads(content)
+
+                ai_message = data.get("response")
+
+                message = save_message(
+                    chat=chat,
+                    role="system",
+                    content=str(query_data),
+                    message_text="",
+                    timestamp=timestamp,
+                )
+
+                new_messages.append({
+                    "message": message.name,
+                    "role": message.role,
+                    "message_text": message.message_text,
+                    "content": message.content,
+                })
+                # chat.append(
+                #     "messages",
+                #     {
+                #         "role": message.role,
+                #         "message_text": message.message_text,
+                #         "content": message.content,
+                #     }
+                # )
+
+                message = save_message(
+                    chat=chat,
+                    role=role,
+                    content=content,
+                    message_text=ai_message,
+                    timestamp=timestamp,
+                )
+
+                new_messages.append({
+                    "message": message.name,
+                    "role": message.role,
+                    "message_text": message.message_text,
+                    "content": message.content,
+                })
+                # chat.append(
+                #     "messages",
+                #     {
+                #         "role": message.role,
+                #         "message_text": message.message_text,
+                #         "content": message.content,
+                #     }
+                # )
+
+    if response_type == "answer" and context.integration == 1 and context.webhook_uri:
+
+        json_body = data.get("json_body")
+        extra_data = post_to_webhook(context, json_body)
     
-    except Exception as e:
-        save_response_log(str(e), "AAAAAAAA", "AAAAAAAAAAAAA")
-        return None
+    get_turn_writer().append_chat_rows(chat.name, new_messages)
+
+    result = {
+        "is_live": chat.is_live,
+        "response": ai_message,
+        "message_type": ai_message_type,
+        "file_link": ai_message_file_link,
+        "caption": ai_message_caption,
+    }
+    reply_stream.finish(result)
+
+    confirm_response(user_message.name, reply_stream.get_metrics())
+    end_turn()
+    
+    return result
 
 
 @frappe.whitelist(allow_guest=True)
@@ -444,6 +486,7 @@ def ai_comment(
             new_message = json.loads(new_message)
 
         context = frappe.get_doc("AI Agent", context_id)
+        set_usage_context(agent=context.name)
 
         messages = get_current_messages(None, context, False)
         messages.append(new_message)
@@ -500,7 +543,7 @@ def ai_comment(
 
 
         if response_type == "answer" and context.integration == 1 and context.webhook_uri:
-            save_response_log(str(data), "PAPAPAPAPAPAP", "PAPAPAPAPAPAP")
+            log_event("webhook", data, "DEBUG")
 
             json_body = data.get("json_body")
             extra_data = post_to_webhook(context, json_body)
@@ -508,64 +551,41 @@ def ai_comment(
         return {"response": ai_message}
     
     except Exception as e:
-        save_response_log(str(e), "AAAAAAAA", "AAAAAAAAAAAAA")
+        log_event("chat", e, "ERROR")
         return None
     
 
 def speech_to_text(model: str, client_credentials, file_name: str, audio_data: BytesIO):
-    creds = frappe.get_doc("Client Credentials", client_credentials)
-    api_key = creds.get_password("api_key")
+    return transcribe_audio(model, client_credentials, file_name, audio_data)
 
-    ai_client = OpenAI(api_key=api_key)
-
-    with audio_data as f:
-        f.name = file_name
-        
-        transcription = ai_client.audio.transcriptions.create(
-            model=model, 
-            file=f,
-        )
-
-    return transcription.text
-    
 
 def text_to_speech(model: str, client_credentials, text: str, voice: str="alloy"):
-    creds = frappe.get_doc("Client Credentials", client_credentials)
-    api_key = creds.get_password("api_key")
-
-    ai_client = OpenAI(api_key=api_key)
-
-    file_name = f"tts_{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}.mp3"
-    output_path = frappe.get_site_path("public", "files", file_name)
-
-    response = ai_client.audio.speech.create(
-        model=model,
-        voice=voice,
-        input=text
-    )
+    return synthesize_speech(model, client_credentials, text, voice)
 
-    with open(output_path, "wb") as f:
-        f.write(response.read())
 
-    public_url = frappe.utils.get_url(f"/files/{file_name}")
-
-    return public_url
-        
-
-
-def ask_local_ai(model, messages, to_account, stream=False):
+def ask_local_ai(model, messages, to_account, stream: ReplyStream=None):
     try:
         settings = frappe.get_doc("Ai Settings", "Ai Settings")
         url = f"{settings.base_url}/chat"
         body = {
             "model": model,
             "messages": messages,
-            "stream": stream,
+            "stream": bool(stream),
         }
-        response = requests.post(url, json=body)
+        started_at = time.perf_counter()
+        response = get_http_session().post(url, json=body, timeout=get_request_timeout(), stream=bool(stream))
 
         if response.status_code == 200:
-            res_message = response.json()["message"]
+            if stream:
+                res_message = read_ollama_stream(response.iter_lines(), stream)
+                usage = get_ollama_usage(res_message["done"])
+            else:
+                data = response.json()
+                res_message = data["message"]
+                usage = get_ollama_usage(data)
+
+            record_usage("Local", model, (time.perf_counter() - started_at) * 1000, **usage)
+
             role = res_message["role"]
             content = res_message["content"]
             content = re.sub(r'[\x00-\x1F\x7F]', '', content)
@@ -576,60 +596,66 @@ def ask_local_ai(model, messages, to_account, stream=False):
             }
     
     except Exception as e:
-        save_response_log(
-            str(e),
-            "Local",
-            to_account,
-        )
+        log_event("llm", e, "ERROR", "Local", to_account)
 
 
-def ask_ollama_ai(model, messages, to_account, stream=False):
+def ask_ollama_ai(model, messages, to_account, stream: ReplyStream=None):
     try:
-        client = Client(
+        client = get_ollama_client(
             host="https://ollama.com",
             headers={'Authorization': '4b78847708a1463297acb80a08716843.SBNnfMMNHiqn8RgfzSIj4E6_'}
         )
 
-        resp = client.chat(model=model, messages=messages, stream=False)
-        msg = resp.get("message") or {}
+        started_at = time.perf_counter()
+        if stream:
+            msg = read_ollama_stream(client.chat(model=model, messages=messages, stream=True), stream)
+            usage = get_ollama_usage(msg["done"])
+        else:
+            resp = client.chat(model=model, messages=messages, stream=False)
+            msg = resp.get("message") or {}
+            usage = get_ollama_usage(resp)
+
+        record_usage("Ollama", model, (time.perf_counter() - started_at) * 1000, **usage)
 
         return {"role": msg.get("role", "assistant"), "content": msg.get("content", "")}
     
     except Exception as e:
-        save_response_log(
-            str(e),
-            "Default",
-            to_account,
-        )
+        log_event("llm", e, "ERROR", "Default", to_account)
 
 
-def ask_gpt_ai(model, context, messages, to_account, stream=False):
+def ask_gpt_ai(model, context, messages, to_account, stream: ReplyStream=None):
     try:
-        creds = frappe.get_doc("Client Credentials", context.client_credentials)
-        api_key = creds.get_password("api_key")
-
-        if api_key:
-            ai_client = OpenAI(api_key=api_key)
-
-            response = ai_client.responses.create(
-                model=model,
-                input=messages,
-                store=False,
-            )
+        ai_client = get_openai_client(context.client_credentials)
+
+        started_at = time.perf_counter()
+        response = create_openai_response(
+            ai_client,
+            stream,
+            model=model,
+            input=messages,
+            store=False,
+        )
+        record_usage(
+            "OpenAI",
+            model,
+            (time.perf_counter() - started_at) * 1000,
+            client_credentials=context.client_credentials,
+            **get_openai_usage(response),
+        )
 
-            role = response.output[0].role
-            content = response.output[0].content[0].text
+        role = response.output[0].role
+        content = response.output[0].content[0].text
 
-            return {
-                "role": role,
-                "content": content,
-            }
+        return {
+            "role": role,
+            "content": content,
+        }
     
     except openai.OpenAIError as e:
-        save_response_log(str(e), "GPT", to_account, True)
+        log_event("llm", e, "ERROR", "GPT", to_account)
 
     except Exception as e:
-        save_response_log(str(e), "GPT", to_account, True)
+        log_event("llm", e, "ERROR", "GPT", to_account)
 
 
 def make_ai_request(method, url, body=None, auth_type=None, auth_token=None, timeout=30):
@@ -686,93 +712,27 @@ def post_to_webhook(context, json_body):
 
 
 @frappe.whitelist()
-def get_current_messages(chat_id, context, include_history=True) -> list:
-    ai_settings = frappe.get_doc("Ai Settings", "Ai Settings")
-
-    def get_remote_context(url):
-        tries = 3
-        while tries > 0:
-            response = requests.get(url, timeout=30)
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                tries -= 1
-
-        return ""
-
-    def get_file_context(file_url):
-        # Download file
-        response = requests.get(file_url)
-        response.raise_for_status()
-        file_data = BytesIO(response.content)
-
-        # Detect file type by extension
-        file_url_lower = file_url.lower()
-        text_content = ""
-
-        if file_url_lower.endswith(".docx"):
-            # Read DOCX
-            doc = Document(file_data)
-            text_content = "\n".join([p.text for p in doc.paragraphs if p.text.strip()])
-
-        elif file_url_lower.endswith(".txt"):
-            # Read plain text
-            text_content = file_data.read().decode("utf-8", errors="ignore")
-
-        elif file_url_lower.endswith(".csv"):
-            # Read CSV
-            df = pd.read_csv(file_data)
-            text_content = df.to_string(index=False)
-
-        elif file_url_lower.endswith((".xlsx", ".xls")):
-            # Read Excel
-            df = pd.read_excel(file_data)
-            text_content = df.to_string(index=False)
-
-        else:
-            raise ValueError("Unsupported file type")
-
-        return text_content.strip()
+def get_current_messages(chat_id, context, include_history=True, exclude: list=None) -> list:
+    history_stats = {"rows": 0, "tokens": 0, "truncated": False}
     if include_history:
-        messageDocs = frappe.get_all(
-            "Ai Messages Table",
-            filters={"parent": chat_id},
+        token_budget, message_limit = get_history_limits(context)
+        messageDocs, history_stats = load_history(
+            chat_id,
             fields=["role", "content"],
-            order_by="idx",
-            limit=0,
+            token_budget=token_budget,
+            message_limit=message_limit,
+            exclude=exclude,
         )
 
     messages = []
 
-    main_rules = ai_settings.main_rules
-    
-    content = AI_SYSTEM_PROMPT
-    content = content.replace("{MAIN_RULES}", main_rules)
-    content = content.replace("{DATE}", datetime.now().strftime("%Y-%m-%d"))
-
-    response_fields = context.response_fields if context.response_fields else ""
-    content = content.replace("{RESPONSE_FIELDS}", response_fields)
-
-    if context.integration == 1 and context.source_type:
-        if context.source_type == "Link":
-            remote_context = get_remote_context(context.source_link)
-        elif context.source_type == "File":
-            remote_context = get_file_context(context.sourec_file)
-        elif context.source_type == "Text":
-            remote_context = context.source_text
-        else:
-            remote_context = ""
-
-        if context.source_type == "Template":
-            content = content.replace("{REQUEST_TYPES}", get_ai_requests_types(context.source_template))
-        else:
-            content = content.replace("{CONTEXT}", str(remote_context))
+    resolvers = {}
+    if context.integration == 1 and context.source_type in ("Link", "File"):
+        resolvers["CONTEXT"] = lambda: get_agent_context(context)
+    elif context.integration == 1 and context.source_type == "Template":
+        resolvers["REQUEST_TYPES"] = lambda: get_ai_requests_types(context.source_template)
 
-    content = content.replace("{INSTRUCTIONS}", context.system_prompt or "")
-    content = content.replace("{JSON}", context.json_template or "")
-    content = content.replace("{COMPLETION}", context.on_completion or "")
-    # content = content.replace("{ERROR}", context.on_error or "")
+    content = build_system_prompt("v1", AI_SYSTEM_PROMPT, context, resolvers)
     
     messages.append({
         "role": "system",
@@ -787,6 +747,8 @@ def get_current_messages(chat_id, context, include_history=True) -> list:
                 "content": m["content"],
             })
 
+    log_prompt_stats(chat_id, context, messages, history_stats)
+
     return messages
 
 
@@ -812,81 +774,29 @@ def getAIResponse(mctName, docName):
     mctDoc = frappe.get_doc('AI Agent', mctName)
     targetDocument = frappe.get_doc(mctDoc.target_doctype, docName)
 
-    formattedText = ''
+    return generate_document_response(mctDoc, targetDocument)
 
-    for row in mctDoc.text_format:
-        ## Concat table row fields
-        if row.linked_field_type == "Table":
-            msg = (row.before if row.before is not None else "")
-            formattedText += msg + '\n'
 
-            # doct = frappe.get_doc("DocType", row.target_doctype)
-            row_children = frappe.get_all(
-                "RAG Children Table",
-                filters={"parent": mctDoc.name, "reference_type": row.target_doctype},
-                fields=["content"],
-            )
-
-            for i, child in enumerate(row_children):
-                child_fields = str(child.content).split(",")
-                table_items = getattr(targetDocument, row.linked_field_name)
-
-                for ti in table_items:
-
-                    content = ""
-                    for f in child_fields:
-                        content += f". {getattr(ti, f)}"
-
-                    ch_row = f"{i}- {content}"
-                    formattedText += ch_row + '\n'
-
-        else:
-            msg = (row.before if row.before is not None else "") + " " + str(getattr(targetDocument, row.field_name)) + " " + (row.after if row.after is not None else "")
-            formattedText += msg + '\n'
-
-    """
-    Search for records by selected references
+@frappe.whitelist()
+def getBulkAIResponse(mctName, docNames=None, filters=None, concurrency=None):
     """
-    for target in mctDoc.reference_targets:
-        alias = "fi"
-        sql_fields = ", ".join(f"{alias}.{field.strip()}" for field in target.fields.split(","))
-        columns = "row_number|" + "|".join(f"{alias}.{field.strip()}" for field in target.fields.split(","))
-
-        formattedText += f"{target.before}\n"
-        formattedText += f"{target.reference} columns: {columns.replace(f'{alias}.', '')}\n"
-        formattedText += f"{target.reference} rows:\n"
-
-        if target.filter_fields != "" and target.filter_fields is not None and len(target.filter_fields.split(",")) > 0 and len(target.filter_fields.split(",")) == len(target.fields_values.split(",")):
-            filter_fields = target.filter_fields.split(",")
-            values = target.fields_values.split(",")
-            sql_filters = []
-            
-            for i, f in enumerate(filter_fields):
-                field = filter_fields[i].strip()
-                value = values[i].strip()
+    Generate responses for many documents of a AI Agent's target doctype in the background.
 
-                sql_filters.append(f"{alias}.{field} LIKE '%{value}%'")
-
-            sql_filters = ", ".join(sql_filters)
-            sql_filters = f"""WHERE {sql_filters}"""
-        else:
-            sql_filters = ""
-
-        query = f"""
-            SELECT {sql_fields}
-            FROM `tab{target.reference}` AS {alias} {sql_filters};
-        """
-
-        target_items = frappe.db.sql(query, as_dict=True)
-
-        for i, item in enumerate(target_items):
-            item_row = f"{i+1}|{'|'.join(str(value) for value in item.values())}\n"
+    Parameters:
+        mctName (str): The name of the AI Agent.
+        docNames (list | str): Names of the target documents, or
+        filters (dict | str): filters selecting them.
+        concurrency (int): How many documents are processed at the same time.
 
-            formattedText += item_row
+    Returns:
+        str: The name of the `Ai Bulk Response` the results are written to.
+    """
+    return start_bulk_response(mctName, docNames, filters, concurrency)
 
-        formattedText += "\n"
 
-    formattedText += '\n' + mctDoc.user_prompt
+def generate_document_response(mctDoc, targetDocument, reference_text=None):
+    """LLM response of a AI Agent for one target document (see `getAIResponse`)."""
+    formattedText = build_document_prompt(mctDoc, targetDocument, reference_text)
 
     systemPrompt = mctDoc.system_prompt
     userPrompt = formattedText
@@ -894,7 +804,7 @@ def getAIResponse(mctName, docName):
     # return userPrompt
 
     try:
-        settings = frappe.get_doc("Ai Settings", "Ai Settings")
+        settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
         url = f"{settings.base_url}/chat"
         messages=[
             {"role": "system", "content": systemPrompt},
@@ -905,10 +815,19 @@ def getAIResponse(mctName, docName):
             "messages": messages,
             "stream": False,
         }
-        response = requests.post(url, json=data)
+        started_at = time.perf_counter()
+        response = get_http_session().post(url, json=data, timeout=get_request_timeout())
 
         if response.status_code == 200:
-            return response.json()["message"]["content"]
+            data = response.json()
+            record_usage(
+                "Local",
+                mctDoc.selected_model,
+                (time.perf_counter() - started_at) * 1000,
+                agent=mctDoc.name,
+                **get_ollama_usage(data),
+            )
+            return data["message"]["content"]
         else:
             frappe.throw("ERROR: response failed")
 
@@ -2,16 +2,32 @@ import frappe
 import requests
 import json
 import re
+import time
 import openai
-from openai import OpenAI
 from datetime import datetime
 from io import BytesIO
-from docx import Document
-import pandas as pd
-from ollama import Client
-from frappe.utils.file_manager import save_file
-from frappe.utils import get_url
-
+from frappe.utils import cint, get_url, sbool
+from ai_intergration.ai_intergration.prompts import build_system_prompt
+from ai_intergration.ai_intergration.context_sources import get_agent_context
+from ai_intergration.ai_intergration.tool_catalog import get_catalog
+from ai_intergration.ai_intergration.history import get_history_limits, load_history, log_prompt_stats
+from ai_intergration.ai_intergration.diagnostics import log_event
+from ai_intergration.ai_intergration.images import ingest_image
+from ai_intergration.ai_intergration.speech import synthesize_speech, transcribe_audio
+from ai_intergration.ai_intergration.message_store import get_message, is_chat_table_storage
+from ai_intergration.ai_intergration.turn_writer import TurnWriter, begin_turn, end_turn, get_turn_writer
+from ai_intergration.ai_intergration.usage import get_openai_usage, record_usage, set_usage_context
+from ai_intergration.ai_intergration.streaming import ReplyStream, create_openai_response
+from ai_intergration.ai_intergration.chat_jobs import deliver_chat_result, enqueue_chat_turn
+from ai_intergration.ai_intergration.tool_calls import execute_tool_calls
+from ai_intergration.ai_intergration.llm_clients import (
+    get_http_session,
+    get_openai_client,
+    get_request_timeout,
+)
+
+
+DEFAULT_MAX_TOOL_STEPS = 4
 
 AI_SYSTEM_PROMPT = """
 Today's Date: {DATE}
@@ -45,7 +61,7 @@ def get_models():
     settings = frappe.get_doc("Ai Settings", "Ai Settings")
     url = f"{settings.base_url}/tags"
 
-    response = requests.get(url)
+    response = get_http_session().get(url, timeout=get_request_timeout())
 
     if response.status_code == 200:
         models = []
@@ -62,89 +78,39 @@ def get_gpt_models():
     try:
         # cred_id = frappe.get_value("Client Credentials", {"user": frappe.session.user})
         # if cred_id:
-            creds = frappe.get_doc("Client Credentials", "Main")
-            api_key = creds.get_password("api_key")
-
-            if api_key:
-                models = []
-                ai_client = OpenAI(api_key=api_key)
-                response = ai_client.models.list()
+            models = []
+            ai_client = get_openai_client("Main")
+            response = ai_client.models.list()
 
-                for model in response.data:
-                    models.append(model.id)
+            for model in response.data:
+                models.append(model.id)
 
-                return models
+            return models
                 
     except Exception as e:
-        save_response_log(str(e), "001", "001", True)
+        log_event("models", e, "ERROR")
         
         frappe.throw("invalid credentials")
 
 
 def save_response_log(body, from_number, to_account, is_error=False):
-    log = frappe.new_doc("WhatsApp Logs")
-    log.from_number = from_number
-    log.to_number = to_account
-    log.method = "Sent"
-    log.timestamp = datetime.now()
-    log.body = body
-    log.is_error = is_error
-    log.save(ignore_permissions=True)
+    # Kept for integrations calling it; new code uses log_event
+    log_event("response", body, "ERROR" if is_error else "INFO", from_number, to_account)
 
 
 def get_ai_requests_types(source_template):
-    source_template = frappe.get_doc("Ai Data Source Template", source_template)
-    sources = source_template.data_source_table
-    strings = []
-    for s in sources:
-        src = frappe.get_doc("Ai Data Source", s.source)
-        
-        strings.append(f"""{{
-        "when": "{src.when.strip() if src.when else ""}",
-        "method": "{src.method.strip()}",
-        "url": "{src.get_full_url()}",
-        "body": {src.get_json_body()},
-        "auth_type": "{src.auth_type.strip() if src.auth_type else ""}",
-        "auth_token": "{src.auth_token.strip() if src.auth_token else ""}",
-        "instructions": "{src.instructions.strip() if src.instructions else ""}"
-    }}""")
-
-    requests = ",\n".join(strings)
-
-    save_response_log(
-        str(requests),
-        "-1-1-1-1-1",
-        "-1-1-1-1-1"
-    )
-    return requests
+    return get_catalog(source_template)["request_types"]
 
 
 def get_tools(context):
+    return get_tool_catalog(context)["tools"]
+
+
+def get_tool_catalog(context):
     if not context.integration or not context.source_template:
-        return []
-    
-    source_template = frappe.get_doc("Ai Data Source Template", context.source_template)
-    sources = source_template.data_source_table
-    tools = []
-    for s in sources:
-        src = frappe.get_doc("Ai Data Source", s.source)
-        props, required_props = src.get_properties()
-
-        tool = {
-            "type": "function",
-            "name": src.name,
-            "description": f"{src.when}. This function calls the {src.method} {src.url} API.",
-            "parameters": {
-                "type": "object",
-                "properties": props,
-                "required": required_props,
-                "additionalProperties": False,
-            },
-            "strict": True
-        }
-        tools.append(tool)
+        return get_catalog(None)
 
-    return tools
+    return get_catalog(context.source_template)
 
 
 def get_external_links(links_template):
@@ -173,37 +139,43 @@ def web_search(context, chat, links):
 
 
 def save_message(chat, role, content, message_text: str=None, image: dict=None, message_type="text", timestamp: datetime=datetime.now()):
-    message = frappe.new_doc("Ai Message")
-    message.chat = chat
-    message.type = message_type
-    message.role = role
-    message.content = content
-    message.message_text = message_text
-    message.timestamp = timestamp
-    message.insert(ignore_permissions=True)
+    writer = get_turn_writer() or TurnWriter()
+    message = writer.new_message(
+        chat=chat,
+        role=role,
+        content=content,
+        message_text=message_text,
+        message_type=message_type,
+        timestamp=timestamp,
+    )
 
     if image:
-        image_content = image.get("content")
-        image_name = image.get("name")
-
-        filedoc = save_file(
-            fname=image_name,
-            content=image_content.getvalue(),
-            dt="Ai Message",
-            dn=message.name,
-            is_private=0
+        # The name is generated up front, so the file is attached before the message is written
+        stored = ingest_image(
+            image.get("content"),
+            image.get("name"),
+            "Ai Chat" if writer.chat_table else "Ai Message",
+            message.chat if writer.chat_table else message.name,
         )
 
-        message.image = filedoc.file_url
-        message.save(ignore_permissions=True)
+        message.image = stored.file_url
+        message.vision_image = stored.vision_url
+
+    if writer is not get_turn_writer():
+        # Outside a turn: write it right away
+        writer.flush(commit=False)
 
     return message
 
 
-def confirm_response(message_id):
-    message = frappe.get_doc("Ai Message", message_id)
-    message.responded_to = 1
-    message.save(ignore_permissions=True)
+def confirm_response(message_id, metrics: dict=None):
+    values = {"responded_to": 1, **(metrics or {})}
+
+    writer = get_turn_writer()
+    if writer:
+        writer.set_value("Ai Message", message_id, values)
+    else:
+        frappe.db.set_value("Ai Messages Table" if is_chat_table_storage() else "Ai Message", message_id, values)
 
 
 @frappe.whitelist(allow_guest=True)
@@ -218,6 +190,8 @@ def ai_chat_v2(
     timestamp: datetime=datetime.now(),
     stream=False,
     context=None,
+    run_async=False,
+    callback_url=None,
 ):
     try:
         if not isinstance(new_message, dict):
@@ -228,7 +202,8 @@ def ai_chat_v2(
             context = frappe.get_doc("AI Agent", chat.context)
 
         is_live = chat.is_live
-        
+
+        begin_turn()
         user_message = save_message(
             chat=chat.name,
             role=new_message["role"],
@@ -239,84 +214,127 @@ def ai_chat_v2(
             timestamp=timestamp,
         )
 
-        new_messages = []
-
         ## Add image to prompt
         if image:
-            image_url = f"{get_url()}{user_message.image}"
+            image_url = f"{get_url()}{user_message.vision_image or user_message.image}"
             text = new_message["content"]
             new_message["content"] = [
                 {"type": "input_text", "text": text},
                 {"type": "input_image", "image_url": image_url}
             ]
 
-        new_messages.append({
-            "role": user_message.role,
-            "message_text": user_message.message_text,
-            "content": user_message.content,
-        })
-
         if is_live:
-            chat.save(ignore_permissions=True)
             confirm_response(user_message.name)
-            frappe.db.commit()
+            get_turn_writer().touch(chat.name)
+            end_turn()
             return {"is_live": is_live, "response": plain_text}
-        
 
-        messages = get_current_messages(chat_id, context)
-        messages.append(new_message)
-            
-        ai_response = ask_gpt_ai(model, context, messages, new_messages, to_account)
-       
-        role = ai_response.get("role")
-        content = ai_response.get("content")
-        # content = content.replace("```json", "").replace("```", "")
+        if sbool(run_async):
+            job_id, result_token = enqueue_chat_turn(
+                "ai_intergration.ai_intergration.api_v2.run_chat_turn",
+                user_message.name,
+                model=model,
+                context_id=context.name,
+                new_message=new_message,
+                to_account=to_account,
+                timestamp=timestamp,
+                stream=stream,
+                # Guests may not make the server call arbitrary URLs; they poll
+                # get_chat_result with the returned result_token instead
+                callback_url=callback_url if frappe.session.user != "Guest" else None,
+            )
+            # The job is enqueued on commit, once the user message is written
+            end_turn()
+            return {"is_live": is_live, "queued": True, "job_id": job_id, "result_token": result_token}
 
-        # data = json.loads(content)
+        return process_chat_turn(model, chat, context, user_message, new_message, to_account, timestamp, stream)
 
-        # ai_message = data.get("response")
-        # ai_message_type = data.get("message_type", "text")
-        # ai_message_file_link = data.get("file_link")
-        # ai_message_caption = data.get("caption")
+    except Exception as e:
+        # Keep what the turn wrote so far, as the request's own commit used to
+        end_turn(commit=False)
+        log_event("chat", e, "ERROR")
+        return None
 
 
-        resp_message = save_message(
-            chat=chat,
-            role=role,
-            content=content,
-            message_text=content,
-            timestamp=timestamp,
-        )
+def run_chat_turn(
+    user_message_id,
+    model,
+    context_id,
+    new_message,
+    to_account=None,
+    timestamp: datetime=None,
+    stream=False,
+    callback_url=None,
+    result_token=None,
+):
+    """Background job for `ai_chat_v2(run_async=True)`."""
+    user_message = get_message(user_message_id)
+    chat = frappe.get_doc("Ai Chat", user_message.chat)
+    context = frappe.get_doc("AI Agent", context_id)
 
-        new_messages.append({
-            "role": resp_message.role,
-            "message_text": resp_message.message_text,
-            "content": resp_message.content,
-        })
+    begin_turn()
+    try:
+        result = process_chat_turn(model, chat, context, user_message, new_message, to_account, timestamp, stream)
+    except Exception as e:
+        end_turn(commit=False)
+        log_event("chat", e, "ERROR")
+        result = None
 
-        # response_type = data.get("type")
-        
-        chat.reload()
-        for msg in new_messages:
-            chat.append(
-                "messages",
-                msg,
-            )
-        chat.save(ignore_permissions=True)
-        confirm_response(user_message.name)
-        frappe.db.commit()
+    deliver_chat_result(chat.name, user_message.name, result, callback_url, result_token)
+    frappe.db.commit()
+
+
+def process_chat_turn(model, chat, context, user_message, new_message, to_account, timestamp, stream=False):
+    set_usage_context(agent=context.name, chat=chat.name)
+
+    new_messages = [{
+        "message": user_message.name,
+        "role": user_message.role,
+        "message_text": user_message.message_text,
+        "content": user_message.content,
+    }]
+
+    reply_stream = ReplyStream(chat.name, publish=sbool(stream))
+
+    # With "Chat Table" storage a queued turn's user message is already a chat row
+    messages = get_current_messages(chat.name, context, exclude=[user_message.name])
+    messages.append(new_message)
         
-        return {
-            "is_live": is_live,
-            "response": content,
-            "message_type": "text",
-            "file_link": "",
-            "caption": "",
-        }
+    ai_response = ask_gpt_ai(model, context, messages, new_messages, to_account, reply_stream)
+   
+    role = ai_response.get("role")
+    content = ai_response.get("content")
+
+    resp_message = save_message(
+        chat=chat.name,
+        role=role,
+        content=content,
+        message_text=content,
+        timestamp=timestamp,
+    )
+
+    new_messages.append({
+        "message": resp_message.name,
+        "role": resp_message.role,
+        "message_text": resp_message.message_text,
+        "content": resp_message.content,
+    })
+
+    get_turn_writer().append_chat_rows(chat.name, new_messages)
+
+    result = {
+        "is_live": chat.is_live,
+        "response": content,
+        "message_type": "text",
+        "file_link": "",
+        "caption": "",
+    }
+    reply_stream.finish(result)
+
+    confirm_response(user_message.name, reply_stream.get_metrics())
+    end_turn()
     
-    except Exception as e:
-        save_response_log(str(e), "AAAAAAAA", "AAAAAAAAAAAAA")
-        return None
+    return result
 
 
 @frappe.whitelist(allow_guest=True)
@@ -333,6 +351,7 @@ def ai_comment(
             new_message = json.loads(new_message)
 
         context = frappe.get_doc("AI Agent", context_id)
+        set_usage_context(agent=context.name)
 
         messages = get_current_messages(None, context, False)
         messages.append(new_message)
@@ -351,67 +370,73 @@ def ai_comment(
         return {"response": ai_message}
     
     except Exception as e:
-        save_response_log(str(e), "AAAAAAAA", "AAAAAAAAAAAAA")
+        log_event("chat", e, "ERROR")
         return None
     
 
 def speech_to_text(model: str, client_credentials, file_name: str, audio_data: BytesIO):
-    creds = frappe.get_doc("Client Credentials", client_credentials)
-    api_key = creds.get_password("api_key")
+    return transcribe_audio(model, client_credentials, file_name, audio_data)
 
-    ai_client = OpenAI(api_key=api_key)
-
-    with audio_data as f:
-        f.name = file_name
-        
-        transcription = ai_client.audio.transcriptions.create(
-            model=model, 
-            file=f,
-        )
-
-    return transcription.text
-    
 
 def text_to_speech(model: str, client_credentials, text: str, voice: str="alloy"):
-    creds = frappe.get_doc("Client Credentials", client_credentials)
-    api_key = creds.get_password("api_key")
-
-    ai_client = OpenAI(api_key=api_key)
-
-    file_name = f"tts_{frappe.utils.now_datetime().strftime('%Y%m%d%H%M%S')}.mp3"
-    output_path = frappe.get_site_path("public", "files", file_name)
-
-    response = ai_client.audio.speech.create(
-        model=model,
-        voice=voice,
-        input=text
-    )
-
-    with open(output_path, "wb") as f:
-        f.write(response.read())
+    return synthesize_speech(model, client_credentials, text, voice)
 
-    public_url = frappe.utils.get_url(f"/files/{file_name}")
 
-    return public_url
-
-
-def ask_gpt_ai(model, context, messages: list, new_messages: list, to_account: str, stream: bool=False):
+def ask_gpt_ai(model, context, messages: list, new_messages: list, to_account: str, stream: ReplyStream=None):
     try:
-        creds = frappe.get_doc("Client Credentials", context.client_credentials)
-        api_key = creds.get_password("api_key")
-
-        if api_key:
-            ai_client = OpenAI(api_key=api_key)
-
-            tools = get_tools(context)
-
-            response = ai_client.responses.create(
+        ai_client = get_openai_client(context.client_credentials)
+
+        catalog = get_tool_catalog(context)
+        tools = catalog["tools"]
+        max_steps = cint(context.get("max_tool_steps")) or DEFAULT_MAX_TOOL_STEPS
+        token_budget = cint(context.get("max_turn_tokens"))
+
+        steps = []
+        used_tokens = 0
+        force_answer = False
+
+        for step in range(1, max_steps + 1):
+            kwargs = {}
+            if tools and (force_answer or step == max_steps):
+                # Out of steps or tokens: the model has to answer with what it has
+                kwargs["tool_choice"] = "none"
+
+            started_at = time.perf_counter()
+            response = create_openai_response(
+                ai_client,
+                stream,
                 model=model,
                 input=messages,
                 tools=tools,
                 store=False,
+                **kwargs,
             )
 
+            latency_ms = (time.perf_counter() - started_at) * 1000
+            usage = get_openai_usage(response)
+            used_tokens += usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+            record_usage("OpenAI", model, latency_ms, client_credentials=context.client_credentials, **usage)
+
+            if response is None or response.status == "incomplete":
+                # The stream ended without a response, or it was cut short: neither is an answer
+                details = response and response.incomplete_details
+                error = (details and details.reason) or "no response"
+                steps.append({"step": step, "latency_ms": int(latency_ms), "error": error})
+                log_agent_steps(context, model, steps)
+                raise Exception(f"AI response step {step} failed: {error}")
+
+            function_calls = [item for item in response.output if item.type == "function_call"]
+            steps.append({
+                "step": step,
+                "latency_ms": int(latency_ms),
+                "input_tokens": usage.get("input_tokens", 0),
+                "output_tokens": usage.get("output_tokens", 0),
+                "tool_calls": len(function_calls),
+            })
+
+            if not function_calls:
+                break
+
             # messages += response.output
             for o in response.output:
                 response_dict = o.model_dump()
@@ -432,80 +457,59 @@ def ask_gpt_ai(model, context, messages: list, new_messages: list, to_account: s
                     "output": json.dumps(response_dict.get("output", "")),
                 })
 
+            calls = [
+                (item.name, json.loads(item.arguments) if item.arguments else {})
+                for item in function_calls
+            ]
 
-            for item in response.output:
-                if item.type == "function_call":
-                    arguments = json.loads(item.arguments) if item.arguments else {}
-
-                    # 3. Execute the function logic
-                    response_body = make_request(item.name, arguments)
+            # 3. Execute the function logic, all calls of the response at once
+            outputs = execute_tool_calls(calls, catalog["specs"])
 
-                    save_response_log(
-                        str(response_body),
-                        "0101010101",
-                        "0101010101"
-                    )
+            for item, response_body in zip(function_calls, outputs):
+                log_event("tool_response", response_body, "DEBUG", item.name)
 
-                    tool_call_response = {
-                        "type": "function_call_output",
-                        "call_id": item.call_id,
-                        "output": json.dumps(response_body)
-                    }
-                    
-                    # 4. Provide function call results to the model
-                    messages.append(tool_call_response)
-                    new_messages.append(tool_call_response)
+                tool_call_response = {
+                    "type": "function_call_output",
+                    "call_id": item.call_id,
+                    "output": json.dumps(response_body)
+                }
+                
+                # 4. Provide function call results to the model
+                messages.append(tool_call_response)
+                new_messages.append(tool_call_response)
 
+            if token_budget and used_tokens >= token_budget:
+                force_answer = True
 
-            response = ai_client.responses.create(
-                model=model,
-                input=messages,
-                tools=tools,
-                store=False,
-            )
+        log_agent_steps(context, model, steps)
 
-            role = response.output[0].role
-            content = response.output[0].content[0].text
+        message = next((o for o in response.output if o.type == "message"), None)
 
-            return {
-                "role": role,
-                "content": content,
-            }
+        return {
+            "role": message.role if message else "assistant",
+            "content": response.output_text,
+            "steps": steps,
+        }
     
     except openai.OpenAIError as e:
-        save_response_log(str(e), "GPT", to_account, True)
+        log_event("llm", e, "ERROR", "GPT", to_account)
 
     except Exception as e:
-        save_response_log(str(e), "GPT", to_account, True)
+        log_event("llm", e, "ERROR", "GPT", to_account)
 
 
 
-def make_request(source_name, args):
-    src = frappe.get_doc("Ai Data Source", source_name)
-    url = src.url
-    method = src.method or "GET"
-    headers = src.get_headers()
-
-    save_response_log(
-        str(url),
-        "115511551155",
-        "115511551155"
-    )
-    
-    # Execute request
-    try:
-        if method == "GET":
-            res = requests.get(url, headers=headers, params=args)
-        else:
-            res = requests.request(method, url, headers=headers, json=args)
-        res.raise_for_status()
-        response_json = res.json()
+def log_agent_steps(context, model, steps):
+    frappe.logger("ai_intergration").info({
+        "event": "ai_agent_steps",
+        "agent": context.name,
+        "model": model,
+        "steps": steps,
+    })
 
-        return json.dumps(response_json)
 
-    except Exception as e:
-        frappe.log_error(f"AI Request failed: {e}", "AI Agent Tool Error")
-        return {"error": str(e)}
+def make_request(source_name, args):
+    return execute_tool_calls([(source_name, args)])[0]
     
 
 def make_ai_request(method, url, body=None, auth_type=None, auth_token=None, timeout=30):
@@ -562,86 +566,25 @@ def post_to_webhook(context, json_body):
 
 
 @frappe.whitelist()
-def get_current_messages(chat_id, context, include_history=True) -> list:
-    ai_settings = frappe.get_doc("Ai Settings", "Ai Settings")
-
-    def get_remote_context(url):
-        tries = 3
-        while tries > 0:
-            response = requests.get(url, timeout=30)
-
-            if response.status_code == 200:
-                return response.json()
-            else:
-                tries -= 1
-
-        return ""
-
-    def get_file_context(file_url):
-        # Download file
-        response = requests.get(file_url)
-        response.raise_for_status()
-        file_data = BytesIO(response.content)
-
-        # Detect file type by extension
-        file_url_lower = file_url.lower()
-        text_content = ""
-
-        if file_url_lower.endswith(".docx"):
-            # Read DOCX
-            doc = Document(file_data)
-            text_content = "\n".join([p.text for p in doc.paragraphs if p.text.strip()])
-
-        elif file_url_lower.endswith(".txt"):
-            # Read plain text
-            text_content = file_data.read().decode("utf-8", errors="ignore")
-
-        elif file_url_lower.endswith(".csv"):
-            # Read CSV
-            df = pd.read_csv(file_data)
-            text_content = df.to_string(index=False)
-
-        elif file_url_lower.endswith((".xlsx", ".xls")):
-            # Read Excel
-            df = pd.read_excel(file_data)
-            text_content = df.to_string(index=False)
-
-        else:
-            raise ValueError("Unsupported file type")
-
-        return text_content.strip()
+def get_current_messages(chat_id, context, include_history=True, exclude: list=None) -> list:
+    history_stats = {"rows": 0, "tokens": 0, "truncated": False}
     if include_history:
-        messageDocs = frappe.get_all(
-            "Ai Messages Table",
-            filters={"parent": chat_id},
-            fields=["*"],
-            order_by="idx",
-            limit=0,
+        token_budget, message_limit = get_history_limits(context)
+        messageDocs, history_stats = load_history(
+            chat_id,
+            fields=["role", "content", "type", "call_id", "call_name", "arguments", "id", "status", "output"],
+            token_budget=token_budget,
+            message_limit=message_limit,
+            exclude=exclude,
         )
 
     messages = []
 
-    main_rules = ai_settings.main_rules
-    
-    content = AI_SYSTEM_PROMPT
-    content = content.replace("{MAIN_RULES}", main_rules)
-    content = content.replace("{DATE}", datetime.now().strftime("%Y-%m-%d"))
-
-    if context.integration == 1 and context.source_type:
-        if context.source_type == "Link":
-            remote_context = get_remote_context(context.source_link)
-        elif context.source_type == "File":
-            remote_context = get_file_context(context.sourec_file)
-        elif context.source_type == "Text":
-            remote_context = context.source_text
-        else:
-            remote_context = ""
-
-        content = content.replace("{CONTEXT}", str(remote_context))
+    resolvers = {}
+    if context.integration == 1 and context.source_type in ("Link", "File"):
+        resolvers["CONTEXT"] = lambda: get_agent_context(context)
 
-    content = content.replace("{INSTRUCTIONS}", context.system_prompt or "")
-    content = content.replace("{COMPLETION}", context.on_completion or "")
-    # content = content.replace("{ERROR}", context.on_error or "")
+    content = build_system_prompt("v2", AI_SYSTEM_PROMPT, context, resolvers)
     
     messages.append({
         "role": "system",
@@ -675,4 +618,6 @@ def get_current_messages(chat_id, context, include_history=True) -> list:
 
             messages.append(msg)
 
+    log_prompt_stats(chat_id, context, messages, history_stats)
+
     return messages
\ No newline at end of file
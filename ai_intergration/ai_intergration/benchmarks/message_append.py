@@ -0,0 +1,85 @@
+"""Per-turn cost of persisting chat messages, by chat length.
+
+    bench --site <site> execute ai_intergration.ai_intergration.benchmarks.message_append.run
+
+Compares the old `chat.reload()` + `append` + `chat.save()` path with
+`append_chat_messages`. Everything runs in a transaction that is rolled back.
+"""
+
+import time
+
+import frappe
+
+from ai_intergration.ai_intergration.message_store import MESSAGE_FIELDS, append_chat_messages, get_field_value
+
+
+SIZES = (10, 1000, 10000)
+TURNS = 10
+
+TURN_MESSAGES = [
+    {"role": "user", "message_text": "Hello", "content": "Hello"},
+    {"role": "assistant", "message_text": "Hi, how can I help?", "content": "Hi, how can I help?"},
+]
+
+
+def run(sizes=SIZES, turns=TURNS):
+    results = []
+
+    for size in sizes:
+        try:
+            chat_id = create_chat(size)
+
+            save_ms = time_turns(turns, lambda: save_path(chat_id))
+            append_ms = time_turns(turns, lambda: append_chat_messages(chat_id, TURN_MESSAGES))
+
+            results.append({"prior_messages": size, "save_ms": save_ms, "append_ms": append_ms})
+        finally:
+            frappe.db.rollback()
+
+    print(f"{'prior messages':>15} {'reload+save (ms)':>18} {'append (ms)':>12}")
+    for r in results:
+        print(f"{r['prior_messages']:>15} {r['save_ms']:>18.2f} {r['append_ms']:>12.2f}")
+
+    return results
+
+
+def save_path(chat_id):
+    chat = frappe.get_doc("Ai Chat", chat_id)
+    chat.reload()
+    for msg in TURN_MESSAGES:
+        chat.append("messages", msg)
+    chat.save(ignore_permissions=True)
+
+
+def time_turns(turns, fn) -> float:
+    started_at = time.perf_counter()
+    for _ in range(turns):
+        fn()
+
+    return (time.perf_counter() - started_at) * 1000 / turns
+
+
+def create_chat(size) -> str:
+    chat = frappe.get_doc({
+        "doctype": "Ai Chat",
+        "user_id": f"bench-{frappe.generate_hash(length=8)}",
+        "channel_type": "Instagram",
+        "model": "bench",
+    })
+    chat.flags.ignore_links = True
+    chat.flags.ignore_mandatory = True
+    chat.insert(ignore_permissions=True)
+
+    now = frappe.utils.now_datetime()
+    values = [
+        [frappe.generate_hash(length=10), now, now, "Administrator", "Administrator", chat.name, "Ai Chat", "messages", i]
+        + [get_field_value(TURN_MESSAGES[i % 2], field) for field in MESSAGE_FIELDS]
+        for i in range(1, size + 1)
+    ]
+    frappe.db.bulk_insert(
+        "Ai Messages Table",
+        ["name", "creation", "modified", "owner", "modified_by", "parent", "parenttype", "parentfield", "idx", *MESSAGE_FIELDS],
+        values,
+    )
+
+    return chat.name
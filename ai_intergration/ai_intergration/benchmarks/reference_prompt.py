@@ -0,0 +1,91 @@
+"""Cost of building the `getAIResponse` reference text over a large target.
+
+    bench --site <site> execute ai_intergration.ai_intergration.benchmarks.reference_prompt.run
+
+Seeds `WhatsApp Logs` with 100k rows and builds the reference text with the
+previous implementation (unbounded SELECT, `+=` per row), with the current
+one without a row limit, and with the default row limit. Everything is rolled
+back.
+"""
+
+import time
+
+import frappe
+from frappe.utils import now_datetime
+
+from ai_intergration.ai_intergration.reference_context import DEFAULT_ROW_LIMIT, get_reference_text
+
+
+ROWS = 100_000
+FIELDS = "category,level,body"
+
+
+def run(rows=ROWS):
+    results = []
+    try:
+        seed(rows)
+
+        results.append(measure("previous", lambda: legacy_reference_text(get_agent(0))))
+        results.append(measure("no row limit", lambda: get_reference_text(get_agent(0))))
+        results.append(measure(f"row limit {DEFAULT_ROW_LIMIT}", lambda: get_reference_text(get_agent(DEFAULT_ROW_LIMIT))))
+    finally:
+        frappe.db.rollback()
+
+    print(f"{'variant':>16} {'ms':>10} {'chars':>12}")
+    for r in results:
+        print(f"{r['variant']:>16} {r['ms']:>10.1f} {r['chars']:>12}")
+
+    return results
+
+
+def measure(variant, fn) -> dict:
+    started_at = time.perf_counter()
+    text = fn()
+
+    return {"variant": variant, "ms": (time.perf_counter() - started_at) * 1000, "chars": len(text)}
+
+
+def get_agent(row_limit):
+    return frappe.get_doc({
+        "doctype": "AI Agent",
+        "reference_targets": [{
+            "before": "Recent activity",
+            "reference": "WhatsApp Logs",
+            "fields": FIELDS,
+            "row_limit": row_limit,
+        }],
+    })
+
+
+def seed(rows):
+    now = now_datetime()
+    frappe.db.bulk_insert(
+        "WhatsApp Logs",
+        ["name", "creation", "modified", "owner", "modified_by", "timestamp", "category", "level", "body"],
+        [
+            [f"bench-ref-{i}", now, now, "Administrator", "Administrator", now, f"category-{i % 20}", "INFO", f"Seeded log entry number {i}"]
+            for i in range(rows)
+        ],
+    )
+
+
+def legacy_reference_text(agent) -> str:
+    # The reference-target loop of getAIResponse before it moved to reference_context
+    formattedText = ""
+    for target in agent.reference_targets:
+        alias = "fi"
+        sql_fields = ", ".join(f"{alias}.{field.strip()}" for field in target.fields.split(","))
+        columns = "row_number|" + "|".join(f"{alias}.{field.strip()}" for field in target.fields.split(","))
+
+        formattedText += f"{target.before}\n"
+        formattedText += f"{target.reference} columns: {columns.replace(f'{alias}.', '')}\n"
+        formattedText += f"{target.reference} rows:\n"
+
+        target_items = frappe.db.sql(f"SELECT {sql_fields} FROM `tab{target.reference}` AS {alias};", as_dict=True)
+
+        for i, item in enumerate(target_items):
+            formattedText += f"{i+1}|{'|'.join(str(value) for value in item.values())}\n"
+
+        formattedText += "\n"
+
+    return formattedText
@@ -0,0 +1,100 @@
+"""Prompt size and latency of retrieved reference rows against the full dump.
+
+    bench --site <site> execute ai_intergration.ai_intergration.benchmarks.reference_retrieval.run
+
+Seeds `WhatsApp Logs` with 100k rows, builds a reference index over them
+(timed separately, as the background job would) and builds the
+`getAIResponse` prompt with every row, with the default row limit and with
+the top-k retrieved rows. The index's size on disk and the memory its
+first load takes (what each worker holds while it stays cached) are
+reported too. Everything is rolled back and the index file is removed.
+"""
+
+import os
+import time
+import tracemalloc
+
+import frappe
+
+from ai_intergration.ai_intergration.benchmarks.reference_prompt import FIELDS, seed
+from ai_intergration.ai_intergration.history import estimate_tokens
+from ai_intergration.ai_intergration.reference_context import DEFAULT_ROW_LIMIT, build_document_prompt
+from ai_intergration.ai_intergration import reference_index
+from ai_intergration.ai_intergration.reference_index import (
+    AgentIndex,
+    build_target_index,
+    delete_index,
+    get_index_path,
+    get_target_signature,
+    load_index,
+    save_index,
+)
+
+
+ROWS = 100_000
+TOP_K = 20
+AGENT = "bench-reference-retrieval"
+USER_PROMPT = "Summarize what happened in category-7 around seeded log entry number 4242."
+
+
+def run(rows=ROWS, top_k=TOP_K):
+    results = []
+    try:
+        seed(rows)
+
+        agent = get_agent(top_k)
+        started_at = time.perf_counter()
+        index = AgentIndex(AGENT)
+        for target in agent.reference_targets:
+            index.targets[get_target_signature(target)] = build_target_index(target)
+        save_index(index)
+        build_ms = (time.perf_counter() - started_at) * 1000
+        index_mb = os.path.getsize(get_index_path(AGENT)) / 1024 / 1024
+        del index
+
+        document = frappe._dict()
+        results.append(measure("every row", lambda: build_document_prompt(get_agent(0, row_limit=0), document)))
+        results.append(measure(f"row limit {DEFAULT_ROW_LIMIT}", lambda: build_document_prompt(get_agent(0), document)))
+        # First call loads the index file; later calls reuse it
+        results.append(measure(f"top {top_k} (cold)", lambda: build_document_prompt(agent, document)))
+        results.append(measure(f"top {top_k}", lambda: build_document_prompt(agent, document)))
+
+        # Measured apart from the timings, which tracing would slow down
+        reference_index._loaded.clear()
+        tracemalloc.start()
+        load_index(AGENT)
+        loaded_mb = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+        tracemalloc.stop()
+    finally:
+        frappe.db.rollback()
+        delete_index(AGENT)
+
+    print(f"index build: {build_ms:.1f} ms, {index_mb:.1f} MB on disk, {loaded_mb:.1f} MB loaded")
+    print(f"{'variant':>16} {'ms':>10} {'tokens':>10}")
+    for r in results:
+        print(f"{r['variant']:>16} {r['ms']:>10.1f} {r['tokens']:>10}")
+
+    return {"build_ms": build_ms, "index_mb": index_mb, "loaded_mb": loaded_mb, "results": results}
+
+
+def measure(variant, fn) -> dict:
+    started_at = time.perf_counter()
+    prompt = fn()
+
+    return {"variant": variant, "ms": (time.perf_counter() - started_at) * 1000, "tokens": estimate_tokens(prompt)}
+
+
+def get_agent(top_k, row_limit=DEFAULT_ROW_LIMIT):
+    agent = frappe.get_doc({
+        "doctype": "AI Agent",
+        "user_prompt": USER_PROMPT,
+        "reference_top_k": top_k,
+        "reference_targets": [{
+            "before": "Recent activity",
+            "reference": "WhatsApp Logs",
+            "fields": FIELDS,
+            "row_limit": row_limit,
+        }],
+    })
+    agent.name = AGENT
+    return agent
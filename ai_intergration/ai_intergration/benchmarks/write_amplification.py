@@ -0,0 +1,77 @@
+"""Rows, statements and bytes written per chat turn, by message storage mode.
+
+    bench --site <site> execute ai_intergration.ai_intergration.benchmarks.write_amplification.run
+
+Each turn is a user message, a tool call with its output and the reply,
+written through `TurnWriter` the way `process_chat_turn` does. Everything is
+rolled back.
+"""
+
+import json
+import time
+
+import frappe
+
+from ai_intergration.ai_intergration.benchmarks.message_append import create_chat
+from ai_intergration.ai_intergration.turn_writer import TurnWriter
+
+
+MODES = ("Both", "Chat Table")
+TURNS = 100
+
+USER_TEXT = "What is the status of my order #10023?"
+REPLY_TEXT = json.dumps({"type": "answer", "response": "Your order was shipped yesterday and arrives on Monday."})
+
+
+def run(turns=TURNS):
+    results = []
+
+    for mode in MODES:
+        try:
+            chat_id = create_chat(0)
+            totals = {"mode": mode, "rows_written": 0, "write_statements": 0, "bytes_written": 0}
+
+            started_at = time.perf_counter()
+            for _ in range(turns):
+                stats, content_bytes = write_turn(chat_id, mode)
+                totals["rows_written"] += stats["rows_written"]
+                totals["write_statements"] += stats["write_statements"]
+                totals["bytes_written"] += content_bytes
+
+            totals["ms_per_turn"] = (time.perf_counter() - started_at) * 1000 / turns
+            results.append(totals)
+        finally:
+            frappe.db.rollback()
+
+    print(f"{'mode':>12} {'rows/turn':>10} {'writes/turn':>12} {'bytes/turn':>11} {'ms/turn':>8}")
+    for r in results:
+        print(
+            f"{r['mode']:>12} {r['rows_written'] / turns:>10.1f} {r['write_statements'] / turns:>12.1f}"
+            f" {r['bytes_written'] / turns:>11.0f} {r['ms_per_turn']:>8.2f}"
+        )
+
+    return results
+
+
+def write_turn(chat_id, mode) -> tuple:
+    writer = TurnWriter(storage=mode)
+
+    user_message = writer.new_message(chat_id, "user", USER_TEXT, message_text=USER_TEXT)
+    rows = [
+        {"message": user_message.name, "role": "user", "content": USER_TEXT, "message_text": USER_TEXT},
+        {"type": "function_call", "call_id": "call_1", "call_name": "get_order", "arguments": '{"order": "10023"}'},
+        {"type": "function_call_output", "call_id": "call_1", "output": '{"status": "shipped"}'},
+    ]
+
+    reply = writer.new_message(chat_id, "assistant", REPLY_TEXT, message_text=REPLY_TEXT)
+    rows.append({"message": reply.name, "role": "assistant", "content": REPLY_TEXT, "message_text": REPLY_TEXT})
+
+    writer.append_chat_rows(chat_id, rows)
+    writer.set_value("Ai Message", user_message.name, {"responded_to": 1})
+
+    # Text stored per copy of each message: content and message_text
+    copies = 1 if writer.chat_table else 2
+    content_bytes = copies * 2 * (len(USER_TEXT) + len(REPLY_TEXT))
+    content_bytes += sum(len(rows[i].get("arguments") or rows[i].get("output")) for i in (1, 2))
+
+    return writer.flush(commit=False), content_bytes
@@ -0,0 +1,333 @@
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.share import add_docshare
+from frappe.utils import add_to_date, cint, now_datetime, sbool
+from frappe.utils.background_jobs import is_job_enqueued
+
+from ai_intergration.ai_intergration.reference_context import get_reference_text
+from ai_intergration.ai_intergration.reference_index import get_top_k
+
+
+MAX_DOCUMENTS = 1000
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 8
+
+REFERENCE_TTL = 24 * 60 * 60
+WORKER_TIMEOUT = 6 * 60 * 60
+
+# A run with no result for this long and no live job is resumed, up to MAX_ATTEMPTS times
+STALE_MINUTES = 30
+MAX_ATTEMPTS = 3
+
+RESULT_EVENT = "ai_bulk_response_result"
+
+
+def start_bulk_response(agent_name, names=None, filters=None, concurrency=None) -> str:
+    """Record the documents to answer for in an `Ai Bulk Response` and queue its preparation.
+
+    Documents are given by `names` or `filters` and only those the user can
+    read are taken. Returns the `Ai Bulk Response` name.
+    """
+    agent = frappe.get_doc("AI Agent", agent_name)
+    agent.check_permission("read")
+
+    if isinstance(names, str):
+        names = json.loads(names)
+    if isinstance(filters, str):
+        filters = json.loads(filters)
+
+    if names:
+        filters = {"name": ["in", names]}
+    elif not filters:
+        frappe.throw(_("Select the documents to generate responses for"))
+
+    documents = frappe.get_list(
+        agent.target_doctype,
+        filters=filters,
+        pluck="name",
+        order_by="name asc",
+        limit=MAX_DOCUMENTS + 1,
+    )
+    if not documents:
+        frappe.throw(_("No {0} found").format(_(agent.target_doctype)))
+    if len(documents) > MAX_DOCUMENTS:
+        frappe.throw(_("At most {0} documents can be processed at once").format(MAX_DOCUMENTS))
+
+    concurrency = min(cint(concurrency) or DEFAULT_CONCURRENCY, MAX_CONCURRENCY, len(documents))
+
+    bulk = frappe.get_doc({
+        "doctype": "Ai Bulk Response",
+        "agent": agent.name,
+        "target_doctype": agent.target_doctype,
+        "status": "Queued",
+        "total": len(documents),
+        "concurrency": concurrency,
+        "items": [{"document": name, "status": "Queued"} for name in documents],
+    }).insert(ignore_permissions=True)
+
+    # Starting a run only needs read access to the agent: share the run with
+    # its owner so they can open it, follow its progress and read the results
+    add_docshare(
+        "Ai Bulk Response",
+        bulk.name,
+        frappe.session.user,
+        read=1,
+        write=1,
+        flags={"ignore_share_permission": True},
+    )
+
+    frappe.enqueue(
+        "ai_intergration.ai_intergration.bulk_responses.prepare_bulk_response",
+        queue="long",
+        job_id=get_prepare_job_id(bulk.name),
+        deduplicate=True,
+        enqueue_after_commit=True,
+        bulk_name=bulk.name,
+    )
+
+    return bulk.name
+
+
+def prepare_bulk_response(bulk_name):
+    """Background job: build the context shared by every document once, then start the workers.
+
+    Without retrieval the reference rows do not depend on the document and
+    are built here, once. With retrieval each worker queries the agent's
+    reference index, which its process loads once.
+    """
+    bulk = frappe.get_doc("Ai Bulk Response", bulk_name)
+    agent = frappe.get_doc("AI Agent", bulk.agent)
+
+    try:
+        if not get_top_k(agent):
+            frappe.cache().set_value(get_reference_key(bulk_name), get_reference_text(agent), expires_in_sec=REFERENCE_TTL)
+    except Exception:
+        frappe.db.rollback()
+        frappe.db.set_value("Ai Bulk Response", bulk_name, "status", "Failed")
+        frappe.db.commit()
+        raise
+
+    frappe.db.set_value("Ai Bulk Response", bulk_name, "status", "Running")
+    frappe.db.commit()
+
+    for worker in range(bulk.concurrency):
+        frappe.enqueue(
+            "ai_intergration.ai_intergration.bulk_responses.run_bulk_worker",
+            queue="long",
+            timeout=WORKER_TIMEOUT,
+            job_id=get_worker_job_id(bulk_name, worker),
+            deduplicate=True,
+            bulk_name=bulk_name,
+            worker=worker,
+            workers=bulk.concurrency,
+        )
+
+
+def run_bulk_worker(bulk_name, worker, workers):
+    """Background job: answer for every `workers`-th queued document, writing each result as it is ready."""
+    from ai_intergration.ai_intergration.api import generate_document_response
+
+    bulk = frappe.get_doc("Ai Bulk Response", bulk_name)
+    agent = frappe.get_doc("AI Agent", bulk.agent)
+    reference_text = frappe.cache().get_value(get_reference_key(bulk_name)) if not get_top_k(agent) else None
+
+    items = [item for item in bulk.items if item.status == "Queued" and (item.idx - 1) % workers == worker]
+    done = 0
+    try:
+        for item in items:
+            started_at = time.perf_counter()
+            try:
+                document = frappe.get_doc(bulk.target_doctype, item.document)
+                values = {
+                    "status": "Done",
+                    "response": generate_document_response(agent, document, reference_text),
+                    "error": None,
+                }
+            except Exception as e:
+                frappe.db.rollback()
+                values = {"status": "Failed", "error": str(e)[:1000]}
+
+            values["response_ms"] = int((time.perf_counter() - started_at) * 1000)
+            save_result(bulk, item, values)
+            done += 1
+    except BaseException as e:
+        # Timed out or failed outside a single document: the rest of this
+        # worker's share must not stay queued forever
+        frappe.db.rollback()
+        fail_items(bulk, [item.name for item in items[done:]], _("Worker stopped: {0}").format(str(e) or type(e).__name__))
+        raise
+
+
+def save_result(bulk, item, values):
+    frappe.db.set_value("Ai Bulk Response Item", item.name, values, update_modified=False)
+
+    counter = "completed" if values["status"] == "Done" else "failed"
+    # `modified` doubles as the run's heartbeat for `resume_stale_runs`
+    frappe.db.sql(
+        f"UPDATE `tabAi Bulk Response` SET `{counter}` = `{counter}` + 1, modified = %s WHERE name = %s",
+        (now_datetime(), bulk.name),
+    )
+    done, total, failed = close_if_done(bulk.name)
+
+    frappe.publish_realtime(
+        RESULT_EVENT,
+        {
+            "bulk_response": bulk.name,
+            "doctype": bulk.target_doctype,
+            "document": item.document,
+            "status": values["status"],
+            "response": values.get("response"),
+            "error": values.get("error"),
+        },
+        user=bulk.owner,
+    )
+    publish_progress(bulk.name, done, total, failed)
+
+
+def fail_items(bulk, item_names, error):
+    """Mark the items among `item_names` that are still queued as failed."""
+    queued = frappe.get_all(
+        "Ai Bulk Response Item",
+        filters={"parent": bulk.name, "name": ["in", item_names], "status": "Queued"},
+        pluck="name",
+    ) if item_names else []
+
+    if queued:
+        frappe.db.sql(
+            """
+            UPDATE `tabAi Bulk Response Item` SET status = 'Failed', error = %s
+            WHERE name IN %s AND status = 'Queued'
+            """,
+            (error[:1000], tuple(queued)),
+        )
+        frappe.db.sql(
+            "UPDATE `tabAi Bulk Response` SET failed = failed + %s, modified = %s WHERE name = %s",
+            (len(queued), now_datetime(), bulk.name),
+        )
+
+    done, total, failed = close_if_done(bulk.name)
+    publish_progress(bulk.name, done, total, failed)
+
+
+def close_if_done(bulk_name) -> tuple:
+    # Whichever worker finishes the last document closes the run
+    frappe.db.sql(
+        """
+        UPDATE `tabAi Bulk Response` SET status = 'Completed'
+        WHERE name = %s AND status IN ('Queued', 'Running') AND completed + failed >= total
+        """,
+        bulk_name,
+    )
+    frappe.db.commit()
+
+    completed, failed, total = frappe.db.get_value("Ai Bulk Response", bulk_name, ["completed", "failed", "total"])
+    return completed + failed, total, failed
+
+
+def publish_progress(bulk_name, done, total, failed):
+    frappe.publish_progress(
+        done * 100 / total,
+        title=_("Generating Responses"),
+        doctype="Ai Bulk Response",
+        docname=bulk_name,
+        description=_("{0} of {1} documents done, {2} failed").format(done, total, failed),
+    )
+
+    if done >= total:
+        frappe.cache().delete_value(get_reference_key(bulk_name))
+
+
+@frappe.whitelist()
+def resume_bulk_response(bulk_name, retry_failed=False):
+    """Queue the documents of a run that are still waiting (and, optionally, those that failed) again."""
+    bulk = frappe.get_doc("Ai Bulk Response", bulk_name)
+    bulk.check_permission("write")
+
+    if is_running(bulk):
+        frappe.throw(_("This run is still being processed"))
+
+    if sbool(retry_failed):
+        frappe.db.sql(
+            """
+            UPDATE `tabAi Bulk Response Item` SET status = 'Queued', error = NULL
+            WHERE parent = %s AND parenttype = 'Ai Bulk Response' AND status = 'Failed'
+            """,
+            bulk.name,
+        )
+        failed = frappe.db.count("Ai Bulk Response Item", {"parent": bulk.name, "status": "Failed"})
+        frappe.db.set_value("Ai Bulk Response", bulk.name, "failed", failed)
+
+    resume(bulk.name)
+
+
+def resume(bulk_name):
+    queued = frappe.db.count("Ai Bulk Response Item", {"parent": bulk_name, "status": "Queued"})
+    if not queued:
+        close_if_done(bulk_name)
+        return
+
+    frappe.db.set_value("Ai Bulk Response", bulk_name, "status", "Queued")
+    frappe.db.sql(
+        "UPDATE `tabAi Bulk Response` SET attempts = attempts + 1 WHERE name = %s",
+        bulk_name,
+    )
+    frappe.enqueue(
+        "ai_intergration.ai_intergration.bulk_responses.prepare_bulk_response",
+        queue="long",
+        job_id=get_prepare_job_id(bulk_name),
+        deduplicate=True,
+        enqueue_after_commit=True,
+        bulk_name=bulk_name,
+    )
+
+
+def resume_stale_runs():
+    """Scheduled job: resume runs whose workers died without a trace, or close them after `MAX_ATTEMPTS`."""
+    stale = frappe.get_all(
+        "Ai Bulk Response",
+        filters={
+            "status": ["in", ["Queued", "Running"]],
+            "modified": ["<", add_to_date(now_datetime(), minutes=-STALE_MINUTES)],
+        },
+        fields=["name", "attempts", "concurrency"],
+    )
+
+    for bulk in stale:
+        if is_running(bulk):
+            continue
+
+        if bulk.attempts >= MAX_ATTEMPTS:
+            item_names = frappe.get_all(
+                "Ai Bulk Response Item",
+                filters={"parent": bulk.name, "status": "Queued"},
+                pluck="name",
+            )
+            fail_items(bulk, item_names, _("Stopped after {0} attempts").format(MAX_ATTEMPTS))
+            frappe.db.set_value("Ai Bulk Response", bulk.name, "status", "Failed")
+        else:
+            resume(bulk.name)
+
+        frappe.db.commit()
+
+
+def is_running(bulk) -> bool:
+    """True while the run's preparation or any of its workers is queued or started."""
+    job_ids = [get_prepare_job_id(bulk.name)]
+    job_ids.extend(get_worker_job_id(bulk.name, worker) for worker in range(cint(bulk.concurrency)))
+
+    return any(is_job_enqueued(job_id) for job_id in job_ids)
+
+
+def get_prepare_job_id(bulk_name) -> str:
+    return f"ai_bulk_response|{frappe.local.site}|{bulk_name}"
+
+
+def get_worker_job_id(bulk_name, worker) -> str:
+    return f"ai_bulk_response|{frappe.local.site}|{bulk_name}|{worker}"
+
+
+def get_reference_key(bulk_name) -> str:
+    return f"ai_bulk_reference|{bulk_name}"
@@ -0,0 +1,91 @@
+import frappe
+
+from ai_intergration.ai_intergration.llm_clients import get_http_session
+
+
+REPLY_EVENT = "ai_chat_reply"
+DEFAULT_QUEUE = "long"
+
+RESULT_TTL = 60 * 60
+
+
+def get_chat_queue() -> str:
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+    return settings.get("chat_queue") or DEFAULT_QUEUE
+
+
+def get_job_id(user_message_id) -> str:
+    return f"ai_chat|{frappe.local.site}|{user_message_id}"
+
+
+def get_result_key(result_token) -> str:
+    return f"ai_chat_result|{result_token}"
+
+
+def enqueue_chat_turn(method, user_message_id, **kwargs) -> tuple:
+    """Queue a chat turn whose user message is already persisted.
+
+    Returns its job id and a random result token. The result can always be
+    polled with `get_chat_result(result_token)`, which is how guest callers
+    (no callback URL, no realtime room) receive it.
+    """
+    job_id = get_job_id(user_message_id)
+    result_token = frappe.generate_hash(length=32)
+
+    frappe.cache().set_value(
+        get_result_key(result_token),
+        {"status": "queued", "job_id": job_id},
+        expires_in_sec=RESULT_TTL,
+    )
+    frappe.enqueue(
+        method,
+        queue=get_chat_queue(),
+        job_id=job_id,
+        deduplicate=True,
+        enqueue_after_commit=True,
+        user_message_id=user_message_id,
+        result_token=result_token,
+        **kwargs,
+    )
+
+    return job_id, result_token
+
+
+@frappe.whitelist(allow_guest=True)
+def get_chat_result(result_token):
+    """Status of a queued chat turn and, once it finished, its result."""
+    return frappe.cache().get_value(get_result_key(result_token)) or {"status": "unknown"}
+
+
+def deliver_chat_result(chat_id, user_message_id, result, callback_url=None, result_token=None):
+    """Send the result of a queued turn to the callback URL and the chat's realtime room, and keep it for polling."""
+    payload = {
+        "job_id": get_job_id(user_message_id),
+        "chat": chat_id,
+        "message": user_message_id,
+        "result": result,
+    }
+
+    if result_token:
+        frappe.cache().set_value(
+            get_result_key(result_token),
+            {"status": "failed" if result is None else "done", **payload},
+            expires_in_sec=RESULT_TTL,
+        )
+
+    frappe.publish_realtime(
+        REPLY_EVENT,
+        payload,
+        doctype="Ai Chat",
+        docname=chat_id,
+        after_commit=True,
+    )
+
+    if not callback_url:
+        return
+
+    try:
+        response = get_http_session("callbacks").post(callback_url, json=payload, timeout=15)
+        response.raise_for_status()
+    except Exception:
+        frappe.log_error(title=f"AI chat callback failed: {chat_id}")
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import time
+from io import BytesIO
+
+import frappe
+import pandas as pd
+from docx import Document
+from frappe.utils import cint
+
+from ai_intergration.ai_intergration.llm_clients import get_http_session
+
+
+DEFAULT_TTL_MINUTES = 60
+TEXT_EXPIRY = 7 * 24 * 60 * 60
+
+SOURCE_TYPES = ("Link", "File")
+
+
+def get_agent_context(context) -> str:
+    """Return the parsed Link/File context of an AI Agent from cache.
+
+    Never does network I/O or parsing: a missing or stale entry schedules a
+    background refresh and the last known text (if any) is returned.
+    """
+    source = get_source_url(context)
+    if not source:
+        return ""
+
+    meta = frappe.cache().get_value(get_meta_key(context.name)) or {}
+    text = None
+
+    if meta.get("source") == source and meta.get("digest"):
+        text = frappe.cache().get_value(get_text_key(meta["digest"]))
+
+    if text is None or is_stale(meta, context):
+        enqueue_refresh(context.name)
+
+    return text or ""
+
+
+def get_source_url(context):
+    if context.integration != 1 or context.source_type not in SOURCE_TYPES:
+        return None
+
+    if context.source_type == "Link":
+        return context.source_link
+
+    return context.source_file
+
+
+def is_stale(meta, context) -> bool:
+    ttl = cint(context.get("context_cache_ttl")) or DEFAULT_TTL_MINUTES
+    return time.time() - meta.get("fetched_at", 0) > ttl * 60
+
+
+def get_meta_key(agent_name):
+    return f"ai_context_source|{agent_name}"
+
+
+def get_text_key(digest):
+    return f"ai_context_text|{digest}"
+
+
+def enqueue_refresh(agent_name):
+    frappe.enqueue(
+        "ai_intergration.ai_intergration.context_sources.refresh_agent_context",
+        queue="short",
+        job_id=f"ai_context_refresh|{frappe.local.site}|{agent_name}",
+        deduplicate=True,
+        agent_name=agent_name,
+    )
+
+
+def refresh_agent_context(agent_name, force=False):
+    """Revalidate and, if the content changed, re-parse an agent's context source."""
+    context = frappe.get_doc("AI Agent", agent_name)
+    source = get_source_url(context)
+    if not source:
+        frappe.cache().delete_value(get_meta_key(agent_name))
+        return
+
+    meta = frappe.cache().get_value(get_meta_key(agent_name)) or {}
+    if meta.get("source") != source:
+        meta = {"source": source}
+    elif meta.get("digest") and frappe.cache().get_value(get_text_key(meta["digest"])) is None:
+        # The parsed text expired or was evicted: a 304 would leave nothing to
+        # serve, so forget the validators and fetch the content again
+        meta = {"source": source}
+    elif not force and not is_stale(meta, context) and meta.get("digest"):
+        return
+
+    if context.source_type == "Link":
+        content, meta = fetch_remote(source, meta)
+    else:
+        content, meta = fetch_file(source, meta)
+
+    if content is not None:
+        digest = hashlib.sha256(content).hexdigest()
+        text_key = get_text_key(digest)
+
+        if frappe.cache().get_value(text_key) is None:
+            if context.source_type == "Link":
+                text = parse_remote_content(content)
+            else:
+                text = parse_file_content(source, content)
+
+            frappe.cache().set_value(text_key, text, expires_in_sec=TEXT_EXPIRY)
+
+        meta["digest"] = digest
+
+    meta["fetched_at"] = time.time()
+    frappe.cache().set_value(get_meta_key(agent_name), meta)
+
+
+def fetch_remote(url, meta, tries=3):
+    """Conditional GET; returns (content, meta) or (None, meta) when unchanged."""
+    headers = {}
+    if meta.get("digest"):
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    response = None
+    while tries > 0:
+        response = get_http_session().get(url, headers=headers, timeout=30)
+        if response.status_code in (200, 304):
+            break
+
+        tries -= 1
+
+    if response is None or response.status_code == 304:
+        return None, meta
+
+    response.raise_for_status()
+
+    meta["etag"] = response.headers.get("ETag")
+    meta["last_modified"] = response.headers.get("Last-Modified")
+
+    return response.content, meta
+
+
+def fetch_file(file_url, meta):
+    if file_url.startswith(("/files/", "/private/files/")):
+        file_doc = frappe.get_doc("File", {"file_url": file_url})
+        content = file_doc.get_content()
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+
+        return content, meta
+
+    return fetch_remote(file_url, meta, tries=1)
+
+
+def parse_remote_content(content: bytes) -> str:
+    try:
+        return str(json.loads(content))
+    except ValueError:
+        return content.decode("utf-8", errors="ignore")
+
+
+def parse_file_content(file_url, content: bytes) -> str:
+    file_data = BytesIO(content)
+
+    # Detect file type by extension
+    file_url_lower = file_url.lower()
+    text_content = ""
+
+    if file_url_lower.endswith(".docx"):
+        doc = Document(file_data)
+        text_content = "\n".join([p.text for p in doc.paragraphs if p.text.strip()])
+
+    elif file_url_lower.endswith(".txt"):
+        text_content = content.decode("utf-8", errors="ignore")
+
+    elif file_url_lower.endswith(".csv"):
+        df = pd.read_csv(file_data)
+        text_content = df.to_string(index=False)
+
+    elif file_url_lower.endswith((".xlsx", ".xls")):
+        df = pd.read_excel(file_data)
+        text_content = df.to_string(index=False)
+
+    else:
+        raise ValueError("Unsupported file type")
+
+    return text_content.strip()
+
+
+def refresh_agent_contexts():
+    """Scheduler job: refresh every Link/File context whose TTL has expired."""
+    agents = frappe.get_all(
+        "AI Agent",
+        filters={"integration": 1, "source_type": ["in", SOURCE_TYPES]},
+        pluck="name",
+    )
+
+    for agent_name in agents:
+        try:
+            refresh_agent_context(agent_name)
+            frappe.db.commit()
+        except Exception:
+            frappe.log_error(title=f"AI context refresh failed: {agent_name}")
+
+
+def on_agent_update(doc, method=None):
+    if get_source_url(doc):
+        enqueue_refresh(doc.name)
@@ -0,0 +1,128 @@
+import random
+
+import frappe
+from frappe.utils import cint, flt, now_datetime
+
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+
+DEFAULT_LEVEL = "INFO"
+DEFAULT_BODY_LIMIT = 2000
+
+# Entries buffered per request or job; anything beyond is counted and dropped
+MAX_BUFFERED = 500
+
+LOG_FIELDS = (
+    "timestamp",
+    "category",
+    "level",
+    "is_error",
+    "method",
+    "from_number",
+    "to_number",
+    "body",
+)
+
+
+def get_log_settings() -> dict:
+    settings = getattr(frappe.local, "ai_log_settings", None)
+    if settings is None:
+        doc = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+        body_limit = doc.get("log_body_limit")
+
+        settings = frappe.local.ai_log_settings = {
+            "level": LEVELS.get(doc.get("log_level") or DEFAULT_LEVEL, LEVELS[DEFAULT_LEVEL]),
+            "body_limit": DEFAULT_BODY_LIMIT if body_limit is None else cint(body_limit),
+            "sample_rates": {
+                row.category: flt(row.sample_rate) / 100
+                for row in doc.get("log_categories") or []
+                if row.category
+            },
+        }
+
+    return settings
+
+
+def log_event(category, body, level="INFO", from_number=None, to_number=None, method="Sent"):
+    """Buffer a `WhatsApp Logs` entry; it is written by a background job once the request ends.
+
+    Entries below the configured level are dropped, entries below ERROR are
+    sampled per category and every body is truncated to the configured limit.
+    """
+    settings = get_log_settings()
+    level_no = LEVELS.get(level, LEVELS[DEFAULT_LEVEL])
+
+    if level_no < settings["level"]:
+        return
+
+    if level_no < LEVELS["ERROR"] and random.random() >= settings["sample_rates"].get(category, 1):
+        return
+
+    records = getattr(frappe.local, "ai_log_records", None)
+    if records is None:
+        records = frappe.local.ai_log_records = []
+
+    if len(records) >= MAX_BUFFERED:
+        frappe.local.ai_log_dropped = getattr(frappe.local, "ai_log_dropped", 0) + 1
+        return
+
+    body = body if isinstance(body, str) else str(body)
+    if settings["body_limit"] and len(body) > settings["body_limit"]:
+        body = f"{body[:settings['body_limit']]}... [{len(body) - settings['body_limit']} characters truncated]"
+
+    records.append({
+        "timestamp": now_datetime(),
+        "category": category,
+        "level": level,
+        "is_error": int(level_no >= LEVELS["ERROR"]),
+        "method": method,
+        "from_number": from_number,
+        "to_number": to_number,
+        "body": body,
+    })
+
+
+def flush_logs():
+    """after_request / after_job hook: hand the buffered entries to a background job."""
+    records = getattr(frappe.local, "ai_log_records", None)
+    dropped = getattr(frappe.local, "ai_log_dropped", 0)
+
+    frappe.local.ai_log_settings = None
+    if not records:
+        return
+
+    frappe.local.ai_log_records = []
+    frappe.local.ai_log_dropped = 0
+
+    if dropped:
+        records.append({
+            "timestamp": now_datetime(),
+            "category": "logging",
+            "level": "WARNING",
+            "is_error": 0,
+            "body": f"{dropped} log entries dropped, more than {MAX_BUFFERED} were buffered",
+        })
+
+    try:
+        frappe.enqueue(
+            "ai_intergration.ai_intergration.diagnostics.write_logs",
+            queue="short",
+            records=records,
+        )
+    except Exception:
+        frappe.logger("ai_intergration").error({"event": "ai_logs_dropped", "entries": len(records)})
+
+
+def write_logs(records):
+    now = now_datetime()
+    user = frappe.session.user
+
+    frappe.db.bulk_insert(
+        "WhatsApp Logs",
+        ["name", "creation", "modified", "owner", "modified_by", *LOG_FIELDS],
+        [
+            [frappe.generate_hash(length=10), now, now, user, user] + [record.get(field) for field in LOG_FIELDS]
+            for record in records
+        ],
+    )
+    frappe.db.commit()
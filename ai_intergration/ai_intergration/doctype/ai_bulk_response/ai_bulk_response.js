@@ -0,0 +1,32 @@
+// Copyright (c) 2026, yazan sorour and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Ai Bulk Response', {
+	refresh: function(frm) {
+		if(frm.doc.status === "Failed" || (frm.doc.status === "Completed" && frm.doc.failed)) {
+			frm.add_custom_button("Retry Failed", () => {
+				resumeBulkResponse(frm, true);
+			}).addClass("btn-primary");
+		}
+
+		if(frm.doc.status === "Queued" || frm.doc.status === "Running") {
+			frm.add_custom_button("Resume", () => {
+				resumeBulkResponse(frm, false);
+			});
+		}
+	}
+});
+
+
+function resumeBulkResponse(frm, retryFailed) {
+	frappe.call({
+		method: "ai_intergration.ai_intergration.bulk_responses.resume_bulk_response",
+		args: {
+			bulk_name: frm.doc.name,
+			retry_failed: retryFailed,
+		},
+		callback: function() {
+			frm.reload_doc();
+		}
+	});
+}
@@ -0,0 +1,8 @@
+# Copyright (c) 2026, yazan sorour and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+class AiBulkResponse(Document):
+	pass
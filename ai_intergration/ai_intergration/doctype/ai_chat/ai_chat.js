@@ -87,7 +87,11 @@ function clearChat(frm) {
                 freeze: true,
                 freeze_message: __('Deleting all messages...'),
                 callback: function(res) {
-                    if(res.message.success) {
+                    if(res.message.success && res.message.queued) {
+                        d.hide();
+                        frappe.show_alert({message: res.message.message, indicator: "blue"});
+                        listenForClear(frm);
+                    } else if(res.message.success) {
                         frappe.msgprint(res.message.message)
                         reload_page();
                     }
@@ -108,6 +112,20 @@ function clearChat(frm) {
 }
 
 
+function listenForClear(frm) {
+	// Progress comes through frappe.publish_progress; this is the final count
+	frappe.realtime.off("ai_chat_cleared");
+	frappe.realtime.on("ai_chat_cleared", (data) => {
+		if(data.chat !== frm.doc.name) return;
+
+		frappe.realtime.off("ai_chat_cleared");
+		frappe.hide_progress();
+		frappe.msgprint(data.message);
+		reload_page();
+	});
+}
+
+
 function getModels(frm) {
 	frappe.call({
 		method: "ai_intergration.ai_intergration.api.get_models",
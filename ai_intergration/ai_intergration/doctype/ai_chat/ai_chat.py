@@ -4,6 +4,15 @@
 import frappe
 from frappe import _
 from frappe.model.document import Document
+from frappe.utils import now_datetime
+
+BATCH_SIZE = 1000
+
+# Chats with more messages than this are cleared by a background job
+BACKGROUND_THRESHOLD = 2000
+
+CLEARED_EVENT = "ai_chat_cleared"
+
 
 class AiChat(Document):
 	pass
@@ -13,39 +22,125 @@ class AiChat(Document):
 def clear_chat(chat_id):
 	try:
 		chat = frappe.get_doc("Ai Chat", chat_id)
+		chat.check_permission("write")
 
-		frappe.set_value("Ai Chat", chat.name, "messages", [])
-
-		channel_type = chat.channel_type
-		if channel_type == "WhatsApp":
-			filters = {
-				"chat": chat.name,
-				"channel_type": chat.channel_type,
-				"whatsapp_instance": chat.whatsapp_instance,
-			}
-		elif channel_type == "Instagram":
-			filters = {
-				"chat": chat.name,
-				"channel_type": chat.channel_type,
-				"instagram_instance": chat.instagram_instance,
+		total = count_chat_messages(chat.name)
+		if total > BACKGROUND_THRESHOLD:
+			frappe.enqueue(
+				"ai_intergration.ai_intergration.doctype.ai_chat.ai_chat.clear_chat_messages",
+				queue="long",
+				timeout=3600,
+				job_id=f"ai_clear_chat|{frappe.local.site}|{chat.name}",
+				deduplicate=True,
+				chat_id=chat.name,
+				publish=True,
+			)
+			return {
+				"success": True,
+				"queued": True,
+				"message": _("Clearing {0} messages in the background.").format(total),
 			}
 
-		messages = frappe.get_list(
-			"Ai Message",
-			filters=filters,
-			limit=0,
+		deleted = clear_chat_messages(chat.name)
+		return {"success": True, "queued": False, "deleted": deleted, "message": get_cleared_message(deleted)}
+
+	except Exception as e:
+		return {"success": False, "error": str(e)}
+
+
+def clear_chat_messages(chat_id, publish=False):
+	"""Delete a chat's `Ai Message` documents, its message rows and their image files.
+
+	Works in batches of `BATCH_SIZE` plain SQL deletes with a commit after
+	each, reporting progress on the chat's form when `publish` is set.
+	"""
+	total = count_chat_messages(chat_id) or 1
+	deleted = {"messages": 0, "rows": 0, "files": 0}
+
+	def progress():
+		frappe.db.commit()
+		if publish:
+			done = deleted["messages"] + deleted["rows"]
+			frappe.publish_progress(
+				min(done * 100 / total, 100),
+				title=_("Clearing Chat"),
+				doctype="Ai Chat",
+				docname=chat_id,
+				description=_("{0} of {1} messages deleted").format(done, total),
+			)
+
+	while True:
+		names = frappe.db.sql_list(
+			"SELECT name FROM `tabAi Message` WHERE chat = %s LIMIT %s",
+			(chat_id, BATCH_SIZE),
 		)
+		if not names:
+			break
 
-		deleted_messages = 0
-		for msg in messages:
-			frappe.delete_doc_if_exists (
-				"Ai Message",
-				msg.name,
-				force=1,
+		deleted["files"] += delete_files(
+			frappe.get_all("File", filters={"attached_to_doctype": "Ai Message", "attached_to_name": ["in", names]}, pluck="name")
+		)
+		frappe.db.sql("DELETE FROM `tabAi Message` WHERE name IN %s", (tuple(names),))
+		deleted["messages"] += len(names)
+		progress()
+
+	while True:
+		rows = frappe.db.sql(
+			"""
+			SELECT name, image
+			FROM `tabAi Messages Table`
+			WHERE parent = %s AND parenttype = 'Ai Chat'
+			LIMIT %s
+			""",
+			(chat_id, BATCH_SIZE),
+			as_dict=True,
+		)
+		if not rows:
+			break
+
+		images = [row.image for row in rows if row.image]
+		if images:
+			deleted["files"] += delete_files(
+				frappe.get_all(
+					"File",
+					filters={"attached_to_doctype": "Ai Chat", "attached_to_name": chat_id, "file_url": ["in", images]},
+					pluck="name",
+				)
 			)
-			deleted_messages += 1
 
-		return {"success": True, "message": f"{_("Chat cleared successfully. Number of deleted messages")} ({deleted_messages})."}
+		frappe.db.sql("DELETE FROM `tabAi Messages Table` WHERE name IN %s", (tuple(row.name for row in rows),))
+		deleted["rows"] += len(rows)
+		progress()
 
-	except Exception as e:
-		return {"success": False, "error": str(e)}
+	frappe.db.set_value("Ai Chat", chat_id, "modified", now_datetime(), update_modified=False)
+	frappe.db.commit()
+
+	if publish:
+		frappe.publish_realtime(
+			CLEARED_EVENT,
+			{"chat": chat_id, "deleted": deleted, "message": get_cleared_message(deleted)},
+			doctype="Ai Chat",
+			docname=chat_id,
+		)
+
+	return deleted
+
+
+def count_chat_messages(chat_id) -> int:
+	return frappe.db.count("Ai Message", {"chat": chat_id}) + frappe.db.count(
+		"Ai Messages Table", {"parent": chat_id, "parenttype": "Ai Chat"}
+	)
+
+
+def delete_files(file_names) -> int:
+	# Images are few next to messages; File's own delete keeps shared files on disk
+	for name in file_names:
+		frappe.delete_doc("File", name, ignore_permissions=True, force=True)
+
+	return len(file_names)
+
+
+def get_cleared_message(deleted) -> str:
+	return _("Chat cleared successfully. Number of deleted messages ({0}), chat rows ({1}), files ({2}).").format(
+		deleted["messages"], deleted["rows"], deleted["files"]
+	)
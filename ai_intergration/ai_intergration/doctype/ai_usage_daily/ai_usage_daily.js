@@ -0,0 +1,8 @@
+// Copyright (c) 2026, yazan sorour and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Ai Usage Daily', {
+	// refresh: function(frm) {
+
+	// }
+});
@@ -0,0 +1,103 @@
+import frappe
+from frappe.utils import cint
+
+
+DEFAULT_TOKEN_BUDGET = 8000
+DEFAULT_MESSAGE_LIMIT = 100
+PAGE_SIZE = 50
+
+# Rough per-message overhead of the chat format, in tokens
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(*values) -> int:
+    """Cheap token estimate (~4 characters per token), good enough for budgeting."""
+    return sum(len(str(v)) for v in values if v) // 4 + MESSAGE_OVERHEAD
+
+
+def get_history_limits(context) -> tuple:
+    token_budget = context.get("history_token_budget")
+    message_limit = context.get("history_message_limit")
+
+    return (
+        DEFAULT_TOKEN_BUDGET if token_budget is None else cint(token_budget),
+        DEFAULT_MESSAGE_LIMIT if message_limit is None else cint(message_limit),
+    )
+
+
+def load_history(chat_id, fields: list, token_budget=0, message_limit=0, exclude: list=None) -> tuple:
+    """Load the newest `Ai Messages Table` rows of a chat that fit the budgets.
+
+    Rows are read newest-first, page by page, and returned oldest-first. A
+    function_call and its function_call_output are only ever taken together.
+    A budget of 0 means no limit. Rows named in `exclude` are skipped.
+    Returns `(rows, stats)`.
+    """
+    fields = list(dict.fromkeys(fields + ["type", "call_id"]))
+
+    rows = []
+    tokens = 0
+    pending = []
+    pending_tokens = 0
+    open_calls = set()
+    truncated = False
+    start = 0
+
+    filters = {"parent": chat_id, "parenttype": "Ai Chat"}
+    if exclude:
+        filters["name"] = ["not in", exclude]
+
+    while not truncated:
+        page = frappe.get_all(
+            "Ai Messages Table",
+            filters=filters,
+            fields=fields,
+            order_by="idx desc",
+            limit_start=start,
+            limit_page_length=PAGE_SIZE,
+        )
+        start += PAGE_SIZE
+
+        for row in page:
+            if row.call_id and row.type == "function_call_output":
+                open_calls.add(row.call_id)
+            elif row.call_id and row.type == "function_call":
+                open_calls.discard(row.call_id)
+
+            pending.append(row)
+            pending_tokens += estimate_tokens(row.get("content"), row.get("output"), row.get("arguments"))
+
+            if open_calls:
+                continue
+
+            if (token_budget and tokens + pending_tokens > token_budget) or (
+                message_limit and len(rows) + len(pending) > message_limit
+            ):
+                truncated = True
+                break
+
+            rows.extend(pending)
+            tokens += pending_tokens
+            pending = []
+            pending_tokens = 0
+
+        if len(page) < PAGE_SIZE:
+            break
+
+    rows.reverse()
+
+    return rows, {"rows": len(rows), "tokens": tokens, "truncated": truncated}
+
+
+def log_prompt_stats(chat_id, context, messages, history_stats):
+    frappe.logger("ai_intergration").info({
+        "event": "ai_prompt_window",
+        "chat": chat_id,
+        "agent": context.name,
+        "history_rows": history_stats["rows"],
+        "history_truncated": history_stats["truncated"],
+        "prompt_tokens_estimate": sum(
+            estimate_tokens(m.get("content"), m.get("output"), m.get("arguments"))
+            for m in messages
+        ),
+    })
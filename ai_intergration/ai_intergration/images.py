@@ -0,0 +1,123 @@
+import os
+
+import frappe
+from frappe.utils import cint
+
+
+# Longest side of the copy sent to vision models
+VISION_MAX_SIZE = 1024
+VISION_QUALITY = 85
+VISION_FOLDER = "ai_vision"
+DEFAULT_VISION_CACHE_SIZE = 500  # MB
+
+
+def ingest_image(content, file_name, attached_to_doctype, attached_to_name) -> frappe._dict:
+    """Store an inbound image once per content and return its URLs.
+
+    The `File` does the one write: an image already stored with the same
+    `content_hash` is reused by `File.save_file`, which then only adds the
+    record pointing at it. Returns `file_url` and `vision_url`, a downscaled
+    copy for vision models (the original when it is small enough).
+    """
+    # Reading a whole BytesIO from the start shares its buffer instead of copying it
+    content.seek(0)
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": get_safe_name(file_name),
+        "content": content.read(),
+        "attached_to_doctype": attached_to_doctype,
+        "attached_to_name": attached_to_name,
+        "is_private": 0,
+    }).insert(ignore_permissions=True)
+
+    return frappe._dict(
+        file_url=file_doc.file_url,
+        vision_url=get_vision_url(file_doc.file_url, file_doc.content_hash),
+    )
+
+
+def get_vision_url(file_url, content_hash) -> str:
+    """Downscaled JPEG of an image, shared by every upload of the same content.
+
+    A cache hit refreshes the copy's mtime, which the eviction job uses as
+    last-used time.
+    """
+    from PIL import Image, ImageOps
+
+    vision_name = f"{content_hash}-{VISION_MAX_SIZE}.jpg"
+    vision_path = os.path.join(get_vision_folder(), vision_name)
+    if os.path.exists(vision_path):
+        try:
+            os.utime(vision_path)
+        except FileNotFoundError:
+            # Evicted in between
+            pass
+        else:
+            return f"/files/{VISION_FOLDER}/{vision_name}"
+
+    source_path = frappe.get_site_path("public", file_url.lstrip("/"))
+    tmp_path = f"{vision_path}.{frappe.generate_hash(length=6)}"
+    try:
+        with Image.open(source_path) as image:
+            if max(image.size) <= VISION_MAX_SIZE:
+                return file_url
+
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((VISION_MAX_SIZE, VISION_MAX_SIZE))
+
+            os.makedirs(get_vision_folder(), exist_ok=True)
+            image.convert("RGB").save(tmp_path, "JPEG", quality=VISION_QUALITY, optimize=True)
+            os.replace(tmp_path, vision_path)
+    except Exception:
+        # Not something Pillow can resize: the model gets the original
+        frappe.logger("ai_intergration").warning({"event": "ai_vision_resize_failed", "file_url": file_url})
+        return file_url
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return f"/files/{VISION_FOLDER}/{vision_name}"
+
+
+def get_vision_folder() -> str:
+    return frappe.get_site_path("public", "files", VISION_FOLDER)
+
+
+def evict_vision_cache():
+    """Scheduled job: delete the least recently used vision copies beyond the size cap."""
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+    cache_size = settings.get("vision_cache_size")
+    max_bytes = (DEFAULT_VISION_CACHE_SIZE if cache_size is None else cint(cache_size)) * 1024 * 1024
+
+    folder = get_vision_folder()
+    if not os.path.isdir(folder):
+        return
+
+    entries = []
+    for entry in os.scandir(folder):
+        # Copies still being written are named `<name>.jpg.<hash>`
+        if entry.is_file() and entry.name.endswith(".jpg"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        total -= size
+        removed += 1
+
+    if removed:
+        frappe.logger("ai_intergration").info({"event": "ai_vision_evicted", "files": removed, "bytes_left": total})
+
+
+def get_safe_name(file_name) -> str:
+    name = os.path.basename(file_name or "image")
+    return "".join(c if c.isalnum() or c in "._-" else "_" for c in name)[-80:] or "image"
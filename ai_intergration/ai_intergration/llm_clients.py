@@ -0,0 +1,141 @@
+import threading
+
+import frappe
+import httpx
+import requests
+from openai import OpenAI
+from ollama import Client
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_TIMEOUT = 60
+
+VERSION_CACHE_KEY = "ai_llm_clients_version"
+
+_clients = {}
+_versions = {}
+_lock = threading.Lock()
+
+
+def get_client_settings() -> dict:
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+
+    return {
+        "pool_size": settings.get("client_pool_size") or DEFAULT_POOL_SIZE,
+        "timeout": settings.get("request_timeout") or DEFAULT_TIMEOUT,
+    }
+
+
+def get_openai_client(client_credentials) -> OpenAI:
+    """Return a keep-alive OpenAI client for the given Client Credentials."""
+    key = (frappe.local.site, "openai", client_credentials)
+
+    def build():
+        creds = frappe.get_doc("Client Credentials", client_credentials)
+        api_key = creds.get_password("api_key")
+        config = get_client_settings()
+
+        return OpenAI(
+            api_key=api_key,
+            timeout=config["timeout"],
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=config["pool_size"],
+                    max_keepalive_connections=config["pool_size"],
+                ),
+                timeout=config["timeout"],
+            ),
+        )
+
+    return _get_or_create(key, build)
+
+
+def get_ollama_client(host, headers=None) -> Client:
+    """Return a keep-alive Ollama client for the given host."""
+    key = (frappe.local.site, "ollama", host)
+
+    def build():
+        config = get_client_settings()
+
+        return Client(
+            host=host,
+            headers=headers,
+            timeout=config["timeout"],
+            limits=httpx.Limits(
+                max_connections=config["pool_size"],
+                max_keepalive_connections=config["pool_size"],
+            ),
+        )
+
+    return _get_or_create(key, build)
+
+
+def get_http_session(name="local") -> requests.Session:
+    """Return a pooled requests session, e.g. for the local `/chat` endpoint."""
+    key = (frappe.local.site, "http", name)
+
+    def build():
+        config = get_client_settings()
+        adapter = HTTPAdapter(
+            pool_connections=config["pool_size"],
+            pool_maxsize=config["pool_size"],
+        )
+
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    return _get_or_create(key, build)
+
+
+def get_request_timeout() -> int:
+    return get_client_settings()["timeout"]
+
+
+def _get_or_create(key, build):
+    _sync_version()
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = build()
+            _clients[key] = client
+
+    return client
+
+
+def _sync_version():
+    """Drop this site's clients when another worker invalidated the registry."""
+    site = frappe.local.site
+    version = frappe.cache().get_value(VERSION_CACHE_KEY)
+
+    if _versions.get(site) != version:
+        _close_site(site)
+        _versions[site] = version
+
+
+def _close_site(site):
+    with _lock:
+        keys = [key for key in _clients if key[0] == site]
+        clients = [_clients.pop(key) for key in keys]
+
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+def clear_clients(doc=None, method=None):
+    """doc_events handler for `Client Credentials` and `Ai Settings`."""
+    version = frappe.generate_hash(length=10)
+    frappe.cache().set_value(VERSION_CACHE_KEY, version)
+
+    _close_site(frappe.local.site)
+    _versions[frappe.local.site] = version
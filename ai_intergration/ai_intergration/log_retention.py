@@ -0,0 +1,93 @@
+import gzip
+import json
+import os
+import time
+
+import frappe
+from frappe.utils import add_days, cint, now_datetime
+
+
+CHUNK_SIZE = 2000
+
+# A run stops after this long; the rest is picked up the next day
+MAX_RUNTIME = 30 * 60
+
+ARCHIVE_FOLDER = "ai_log_archive"
+
+ARCHIVE_FIELDS = (
+    "name",
+    "creation",
+    "timestamp",
+    "category",
+    "level",
+    "is_error",
+    "method",
+    "from_number",
+    "to_number",
+    "body",
+    "request_body",
+)
+
+
+def purge_logs():
+    """Scheduled job: delete `WhatsApp Logs` past the retention period, archiving them first.
+
+    Rows are removed oldest-first in chunks of `CHUNK_SIZE` primary keys, with
+    a commit after each chunk, so no lock is held for long.
+    """
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+    retention_days = cint(settings.get("log_retention_days"))
+    if retention_days <= 0:
+        return
+
+    archive = cint(settings.get("archive_logs"))
+    cutoff = add_days(now_datetime(), -retention_days)
+    started_at = time.monotonic()
+    removed = 0
+
+    while time.monotonic() - started_at < MAX_RUNTIME:
+        rows = frappe.db.sql(
+            f"""
+            SELECT {", ".join(f"`{field}`" for field in ARCHIVE_FIELDS)}
+            FROM `tabWhatsApp Logs`
+            WHERE `timestamp` < %s
+            ORDER BY `timestamp`
+            LIMIT %s
+            """,
+            (cutoff, CHUNK_SIZE),
+            as_dict=True,
+        )
+        if not rows:
+            break
+
+        if archive:
+            archive_rows(rows)
+
+        frappe.db.sql(
+            "DELETE FROM `tabWhatsApp Logs` WHERE name IN %s",
+            (tuple(row.name for row in rows),),
+        )
+        frappe.db.commit()
+        removed += len(rows)
+
+    frappe.logger("ai_intergration").info({
+        "event": "ai_logs_purged",
+        "removed": removed,
+        "cutoff": str(cutoff),
+        "archived": bool(archive),
+    })
+
+
+def get_archive_path() -> str:
+    folder = frappe.get_site_path("private", ARCHIVE_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+
+    return os.path.join(folder, f"whatsapp_logs-{now_datetime():%Y-%m-%d}.jsonl.gz")
+
+
+def archive_rows(rows):
+    # Each chunk is appended as its own gzip member; the file still reads as one stream
+    with gzip.open(get_archive_path(), "at", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, default=str, ensure_ascii=False))
+            f.write("\n")
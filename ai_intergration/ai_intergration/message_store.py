@@ -0,0 +1,135 @@
+import frappe
+from frappe.utils import now_datetime
+
+
+CHAT_TABLE = "Chat Table"
+BOTH = "Both"
+
+MESSAGE_FIELDS = (
+    "message",
+    "role",
+    "content",
+    "message_text",
+    "type",
+    "call_id",
+    "output",
+    "id",
+    "status",
+    "arguments",
+    "call_name",
+    "timestamp",
+    "message_type",
+    "image",
+    "whatsapp_message_id",
+    "responded_to",
+    "response_type",
+    "first_token_ms",
+    "response_ms",
+)
+
+# Non-null columns, written explicitly by the bulk insert
+FIELD_DEFAULTS = {
+    "responded_to": 0,
+    "response_type": "Normal",
+    "message_type": "text",
+    "first_token_ms": 0,
+    "response_ms": 0,
+}
+
+# `Ai Message` fields and the `Ai Messages Table` columns holding them
+VIEW_FIELDS = {
+    "name": "name",
+    "chat": "parent",
+    "role": "role",
+    "content": "content",
+    "message_text": "message_text",
+    "type": "message_type",
+    "call_id": "call_id",
+    "output": "output",
+    "timestamp": "timestamp",
+    "image": "image",
+    "whatsapp_message_id": "whatsapp_message_id",
+    "responded_to": "responded_to",
+    "response_type": "response_type",
+    "first_token_ms": "first_token_ms",
+    "response_ms": "response_ms",
+}
+
+
+def get_storage_mode() -> str:
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+    return settings.get("message_storage") or BOTH
+
+
+def is_chat_table_storage(storage=None) -> bool:
+    """True when `Ai Messages Table` rows are the only copy of a message."""
+    return (storage or get_storage_mode()) == CHAT_TABLE
+
+
+def get_message(name):
+    """Read a message from `Ai Message`, or from its `Ai Messages Table` row.
+
+    Rows are returned with the fields of an `Ai Message`, so callers do not
+    depend on the storage mode the message was written with.
+    """
+    message = frappe.db.get_value("Ai Message", name, list(VIEW_FIELDS), as_dict=True)
+    if message:
+        return message
+
+    message = frappe.db.get_value(
+        "Ai Messages Table",
+        {"name": name, "parenttype": "Ai Chat"},
+        [f"{column} as {field}" for field, column in VIEW_FIELDS.items()],
+        as_dict=True,
+    )
+    if not message:
+        frappe.throw(f"Ai Message {name} not found", frappe.DoesNotExistError)
+
+    return message
+
+
+def append_chat_messages(chat_id, messages: list):
+    """Insert new `Ai Messages Table` rows without loading or re-saving the chat.
+
+    Cost is independent of the chat's length: the parent row is locked to
+    serialise concurrent turns, the last `idx` is read, the new rows are
+    bulk-inserted and only the parent's `modified` is touched. A message may
+    carry its own `name`, which the row then keeps.
+    """
+    now = now_datetime()
+    user = frappe.session.user
+
+    frappe.db.sql("SELECT name FROM `tabAi Chat` WHERE name = %s FOR UPDATE", chat_id)
+
+    if messages:
+        last_idx = frappe.db.sql(
+            """
+            SELECT COALESCE(MAX(idx), 0)
+            FROM `tabAi Messages Table`
+            WHERE parent = %s AND parenttype = 'Ai Chat' AND parentfield = 'messages'
+            """,
+            chat_id,
+        )[0][0]
+
+        values = []
+        for i, message in enumerate(messages, start=1):
+            values.append(
+                [message.get("name") or frappe.generate_hash(length=10), now, now, user, user, chat_id, "Ai Chat", "messages", last_idx + i]
+                + [get_field_value(message, field) for field in MESSAGE_FIELDS]
+            )
+
+        frappe.db.bulk_insert(
+            "Ai Messages Table",
+            ["name", "creation", "modified", "owner", "modified_by", "parent", "parenttype", "parentfield", "idx", *MESSAGE_FIELDS],
+            values,
+        )
+
+    frappe.db.sql(
+        "UPDATE `tabAi Chat` SET modified = %s, modified_by = %s WHERE name = %s",
+        (now, user, chat_id),
+    )
+
+
+def get_field_value(message, field):
+    value = message.get(field)
+    return FIELD_DEFAULTS.get(field) if value is None else value
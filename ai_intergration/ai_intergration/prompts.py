@@ -0,0 +1,239 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import frappe
+
+
+PLACEHOLDER_RE = re.compile(r"\{([A-Z_]+)\}")
+DIVIDER_RE = re.compile(r"^(-{3,}\n)", re.M)
+
+CACHE_SIZE = 256
+STATS_CACHE_KEY = "ai_prompt_cache_stats"
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+class PromptTemplate:
+    """A system prompt parsed once into sections of literals and placeholders.
+
+    A section is a `----/Title/----` header and the body below it. A section
+    whose body is only placeholders is dropped once they all render empty;
+    text after the last divider belongs to the last section, so the unused
+    `{ERROR}` retry block goes as a whole. Literal text in a body is always
+    kept, and an empty placeholder alone on its line takes the line with it.
+    """
+
+    def __init__(self, source=None, sections=None):
+        if sections is None:
+            sections = _parse(source)
+
+        self.sections = sections
+        self.placeholders = {
+            part[1] for section in sections for parts in section for part in parts if isinstance(part, tuple)
+        }
+
+    def bind(self, values: dict) -> "PromptTemplate":
+        """Fill the given placeholders and keep the rest as slots."""
+        sections = []
+        for head, body, tail in self.sections:
+            if _is_unused(body, values):
+                continue
+
+            sections.append((_bind(head, values), _bind(body, values), _bind(tail, values)))
+
+        return PromptTemplate(sections=sections)
+
+    def render(self, values: dict = None) -> str:
+        bound = self.bind({name: (values or {}).get(name) for name in self.placeholders})
+        return "".join(part for section in bound.sections for parts in section for part in parts)
+
+
+def _is_unused(body, values) -> bool:
+    names = [part[1] for part in body if isinstance(part, tuple)]
+    return (
+        bool(names)
+        and all(isinstance(part, tuple) or not part.strip() for part in body)
+        and all(name in values and not str(values[name] or "").strip() for name in names)
+    )
+
+
+def _bind(parts, values) -> list:
+    bound = []
+    drop_newline = False
+
+    for part in parts:
+        if isinstance(part, tuple) and part[1] in values:
+            text = str(values[part[1]] or "")
+            # An empty placeholder alone on its line takes the line break with it
+            drop_newline = part[2] and not text
+            _append_text(bound, text)
+            continue
+
+        if isinstance(part, tuple):
+            bound.append(part)
+        else:
+            _append_text(bound, part[1:] if drop_newline else part)
+
+        drop_newline = False
+
+    return bound
+
+
+def _parse(source) -> list:
+    """`(head, body, tail)` sections, each a list of parts (see `_parse_parts`)."""
+    # Text, then alternating dividers and the text between them
+    pieces = DIVIDER_RE.split(source)
+
+    sections = [([], _parse_parts(pieces[0]), [])]
+    i = 1
+    while i < len(pieces):
+        if i + 3 < len(pieces):
+            # divider, title, divider, body
+            sections.append((_parse_parts("".join(pieces[i:i + 3])), _parse_parts(pieces[i + 3]), []))
+            i += 4
+        else:
+            head, body, _ = sections[-1]
+            sections[-1] = (head, body, _parse_parts("".join(pieces[i:])))
+            break
+
+    return sections
+
+
+def _parse_parts(source) -> list:
+    """Literal strings and `("var", name, alone_on_line)` tuples."""
+    parts = []
+    position = 0
+    for match in PLACEHOLDER_RE.finditer(source):
+        alone = (
+            source[match.end():match.end() + 1] == "\n"
+            and (match.start() == 0 or source[match.start() - 1] == "\n")
+        )
+        _append_text(parts, source[position:match.start()])
+        parts.append(("var", match.group(1), alone))
+        position = match.end()
+
+    _append_text(parts, source[position:])
+    return parts
+
+
+def _append_text(parts, text):
+    if not text:
+        return
+
+    if parts and isinstance(parts[-1], str):
+        parts[-1] += text
+    else:
+        parts.append(text)
+
+
+def get_static_values(context, settings) -> dict:
+    values = {
+        "DATE": datetime.now().strftime("%Y-%m-%d"),
+        "MAIN_RULES": settings.main_rules or "",
+        "RESPONSE_FIELDS": context.response_fields or "",
+        "INSTRUCTIONS": context.system_prompt or "",
+        "JSON": context.json_template or "",
+        "COMPLETION": context.on_completion or "",
+    }
+
+    if context.integration == 1 and context.source_type == "Text":
+        values["CONTEXT"] = context.source_text or ""
+
+    return values
+
+
+def get_agent_prompt(template_name, source, context) -> PromptTemplate:
+    """Return the agent's prompt with every static placeholder already rendered."""
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+    key = (
+        frappe.local.site,
+        template_name,
+        context.name,
+        str(context.modified),
+        str(settings.modified),
+        datetime.now().strftime("%Y-%m-%d"),
+    )
+
+    with _lock:
+        template = _cache.get(key)
+        if template is not None:
+            _cache.move_to_end(key)
+
+    if template is not None:
+        _record_stats(hits=1)
+        return template
+
+    start = time.perf_counter()
+    template = PromptTemplate(source).bind(get_static_values(context, settings))
+    _record_stats(misses=1, compile_ms=(time.perf_counter() - start) * 1000)
+
+    with _lock:
+        _cache[key] = template
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return template
+
+
+def build_system_prompt(template_name, source, context, resolvers: dict = None) -> str:
+    """Render the agent's cached prompt, resolving only the dynamic slots it still uses."""
+    template = get_agent_prompt(template_name, source, context)
+
+    start = time.perf_counter()
+    values = {
+        name: resolver()
+        for name, resolver in (resolvers or {}).items()
+        if name in template.placeholders
+    }
+    content = template.render(values)
+    _record_stats(render_ms=(time.perf_counter() - start) * 1000)
+
+    return content
+
+
+def _record_stats(**values):
+    try:
+        cache = frappe.cache()
+        key = cache.make_key(STATS_CACHE_KEY)
+        for field, value in values.items():
+            if isinstance(value, float):
+                cache.hincrbyfloat(key, field, value)
+            else:
+                cache.hincrby(key, field, value)
+    except Exception:
+        pass
+
+
+@frappe.whitelist()
+def get_prompt_cache_stats():
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    fields = ("hits", "misses", "compile_ms", "render_ms")
+    raw = cache.hmget(cache.make_key(STATS_CACHE_KEY), fields)
+    stats = {field: float(value or 0) for field, value in zip(fields, raw)}
+
+    hits = stats.get("hits", 0)
+    misses = stats.get("misses", 0)
+    total = hits + misses
+
+    return {
+        "hits": int(hits),
+        "misses": int(misses),
+        "hit_rate": round(hits / total, 4) if total else 0,
+        "avg_compile_ms": round(stats.get("compile_ms", 0) / misses, 3) if misses else 0,
+        "avg_render_ms": round(stats.get("render_ms", 0) / total, 3) if total else 0,
+        "cached_prompts": len(_cache),
+    }
+
+
+@frappe.whitelist()
+def reset_prompt_cache_stats():
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    cache.delete(cache.make_key(STATS_CACHE_KEY))
@@ -0,0 +1,176 @@
+"""EXPLAIN the chat hot-path queries on a seeded dataset.
+
+    bench --site <site> ai-audit-queries
+
+Seeds chats, messages, chat rows and logs inside a transaction, EXPLAINs
+each query and rolls everything back. A query whose plan reads its table
+with a full scan (`ALL`) or a full index scan (`index`) fails the audit.
+"""
+
+import frappe
+from frappe.utils import add_days, now_datetime
+
+
+DEFAULT_CHATS = 200
+DEFAULT_MESSAGES_PER_CHAT = 50
+
+FULL_SCANS = ("ALL", "index")
+
+# (label, table, query); values come from the seeded probe chat
+QUERIES = (
+    (
+        "history page",
+        "tabAi Messages Table",
+        """
+        SELECT role, content, type, call_id FROM `tabAi Messages Table`
+        WHERE parent = %(chat)s AND parenttype = 'Ai Chat'
+        ORDER BY idx DESC LIMIT 50
+        """,
+    ),
+    (
+        "append: last idx",
+        "tabAi Messages Table",
+        """
+        SELECT COALESCE(MAX(idx), 0) FROM `tabAi Messages Table`
+        WHERE parent = %(chat)s AND parenttype = 'Ai Chat' AND parentfield = 'messages'
+        """,
+    ),
+    (
+        "clear chat: messages",
+        "tabAi Message",
+        "SELECT name FROM `tabAi Message` WHERE chat = %(chat)s LIMIT 1000",
+    ),
+    (
+        "messages by chat and WhatsApp instance",
+        "tabAi Message",
+        """
+        SELECT name FROM `tabAi Message`
+        WHERE chat = %(chat)s AND channel_type = 'WhatsApp' AND whatsapp_instance = %(whatsapp_instance)s
+        """,
+    ),
+    (
+        "messages by chat and Instagram instance",
+        "tabAi Message",
+        """
+        SELECT name FROM `tabAi Message`
+        WHERE chat = %(instagram_chat)s AND channel_type = 'Instagram' AND instagram_instance = %(instagram_instance)s
+        """,
+    ),
+    (
+        "chat by phone",
+        "tabAi Chat",
+        "SELECT name FROM `tabAi Chat` WHERE phone_id = %(phone_id)s AND whatsapp_instance = %(whatsapp_instance)s",
+    ),
+    (
+        "chat by Instagram user",
+        "tabAi Chat",
+        "SELECT name FROM `tabAi Chat` WHERE user_id = %(user_id)s AND instagram_instance = %(instagram_instance)s",
+    ),
+    (
+        "log retention",
+        "tabWhatsApp Logs",
+        "SELECT name FROM `tabWhatsApp Logs` WHERE `timestamp` < %(cutoff)s ORDER BY `timestamp` LIMIT 2000",
+    ),
+    (
+        "recent errors",
+        "tabWhatsApp Logs",
+        "SELECT name FROM `tabWhatsApp Logs` WHERE is_error = 1 AND `timestamp` > %(cutoff)s",
+    ),
+)
+
+
+def run_audit(chats=DEFAULT_CHATS, messages_per_chat=DEFAULT_MESSAGES_PER_CHAT) -> list:
+    """Return one result per query: its plan for the audited table and whether it passed."""
+    results = []
+    try:
+        values = seed(chats, messages_per_chat)
+
+        for label, table, query in QUERIES:
+            plan = frappe.db.sql(f"EXPLAIN {query}", values, as_dict=True)
+            step = next((row for row in plan if row.table == table), plan[0])
+
+            results.append({
+                "query": label,
+                "type": step.type,
+                "key": step.key,
+                "rows": step.rows,
+                "extra": step.Extra,
+                "passed": step.type not in FULL_SCANS,
+            })
+    finally:
+        frappe.db.rollback()
+
+    return results
+
+
+def seed(chats, messages_per_chat) -> dict:
+    now = now_datetime()
+    base = ["name", "creation", "modified", "owner", "modified_by"]
+    prefix = f"audit-{frappe.generate_hash(length=6)}"
+
+    chat_rows = []
+    message_rows = []
+    table_rows = []
+    log_rows = []
+    for c in range(chats):
+        chat = f"{prefix}-{c}"
+        whatsapp = c % 2 == 0
+        chat_rows.append([
+            chat, now, now, "Administrator", "Administrator",
+            "WhatsApp" if whatsapp else "Instagram",
+            f"{prefix}-wa-{c % 10}" if whatsapp else None,
+            f"9665{c:08d}" if whatsapp else None,
+            None if whatsapp else f"{prefix}-ig-{c % 10}",
+            None if whatsapp else f"ig{c:08d}",
+        ])
+
+        for m in range(1, messages_per_chat + 1):
+            name = f"{chat}-{m}"
+            message_rows.append([
+                name, now, now, "Administrator", "Administrator",
+                chat, "WhatsApp" if whatsapp else "Instagram",
+                chat_rows[-1][6], chat_rows[-1][8], "user" if m % 2 else "assistant", "seeded",
+            ])
+            table_rows.append([
+                name, now, now, "Administrator", "Administrator",
+                chat, "Ai Chat", "messages", m, "user" if m % 2 else "assistant", "seeded",
+            ])
+            log_rows.append([
+                name, now, now, "Administrator", "Administrator",
+                add_days(now, -(m % 60)), int(m % 10 == 0), "audit", "seeded",
+            ])
+
+    frappe.db.bulk_insert(
+        "Ai Chat",
+        [*base, "channel_type", "whatsapp_instance", "phone_id", "instagram_instance", "user_id"],
+        chat_rows,
+    )
+    frappe.db.bulk_insert(
+        "Ai Message",
+        [*base, "chat", "channel_type", "whatsapp_instance", "instagram_instance", "role", "content"],
+        message_rows,
+    )
+    frappe.db.bulk_insert(
+        "Ai Messages Table",
+        [*base, "parent", "parenttype", "parentfield", "idx", "role", "content"],
+        table_rows,
+    )
+    frappe.db.bulk_insert(
+        "WhatsApp Logs",
+        [*base, "timestamp", "is_error", "category", "body"],
+        log_rows,
+    )
+
+    # A chat from the middle of the data set, on each channel
+    whatsapp_chat = chat_rows[(chats // 2) & ~1]
+    instagram_chat = chat_rows[(chats // 2) | 1]
+
+    return {
+        "chat": whatsapp_chat[0],
+        "whatsapp_instance": whatsapp_chat[6],
+        "phone_id": whatsapp_chat[7],
+        "instagram_chat": instagram_chat[0],
+        "instagram_instance": instagram_chat[8],
+        "user_id": instagram_chat[9],
+        "cutoff": add_days(now, -30),
+    }
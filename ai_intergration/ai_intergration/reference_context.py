@@ -0,0 +1,197 @@
+import hashlib
+import json
+
+import frappe
+from frappe import _
+from frappe.model import default_fields
+from frappe.utils import cint
+
+from ai_intergration.ai_intergration.reference_index import get_top_k, search_target
+
+
+DEFAULT_ROW_LIMIT = 500
+
+RESULT_CACHE_TTL = 60 * 60
+# Larger results are read from the database every time rather than cached
+MAX_CACHED_ROWS = 5000
+
+
+def build_document_prompt(agent, document, reference_text=None) -> str:
+    """User prompt of `getAIResponse`: the formatted document, the reference rows and the agent's prompt.
+
+    With a `reference_top_k` the reference rows are the ones the agent's
+    reference index ranks highest for the document and the prompt. Otherwise
+    they do not depend on the document, and callers handling several
+    documents can build `reference_text` once with `get_reference_text`.
+    """
+    format_text = get_format_text(agent, document)
+    if reference_text is None:
+        reference_text = get_reference_text(agent, query=f"{format_text}\n{agent.user_prompt or ''}")
+
+    return f"{format_text}{reference_text}\n{agent.user_prompt or ''}"
+
+
+def get_format_text(agent, document) -> str:
+    # Children come with the agent, grouped once instead of a query per table row
+    children = {}
+    for child in agent.context_children:
+        children.setdefault(child.reference_type, []).append(
+            [f.strip() for f in str(child.content).split(",") if f.strip()]
+        )
+
+    lines = []
+    for row in agent.text_format:
+        if row.linked_field_type == "Table":
+            lines.append(row.before or "")
+
+            table_items = document.get(row.linked_field_name) or []
+            for i, child_fields in enumerate(children.get(row.target_doctype, [])):
+                for item in table_items:
+                    lines.append(f"{i}- " + "".join(f". {item.get(f)}" for f in child_fields))
+        else:
+            lines.append(f"{row.before or ''} {document.get(row.field_name)} {row.after or ''}")
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+def get_reference_text(agent, query=None) -> str:
+    """Rows of every reference target, as pipe-separated text.
+
+    Given a `query`, targets with an up-to-date reference index only
+    contribute their `reference_top_k` best matching rows.
+    """
+    top_k = get_top_k(agent) if query is not None else 0
+
+    parts = []
+    for target in agent.reference_targets:
+        fields = get_target_fields(target)
+
+        rows = search_target(agent, target, query, top_k) if top_k else None
+        if rows is None:
+            rows = [[row[f] for f in fields] for row in get_target_rows(target, fields, agent.name)]
+
+        parts.append(f"{target.before}\n")
+        parts.append(f"{target.reference} columns: row_number|{'|'.join(fields)}\n")
+        parts.append(f"{target.reference} rows:\n")
+        parts.extend(
+            f"{i}|{'|'.join(str(value) for value in row)}\n"
+            for i, row in enumerate(rows, start=1)
+        )
+        parts.append("\n")
+
+    return "".join(parts)
+
+
+def get_target_fields(target) -> list:
+    """The target's comma-separated `fields`, checked against its doctype."""
+    meta = frappe.get_meta(target.reference)
+
+    fields = [f.strip() for f in (target.fields or "").split(",") if f.strip()]
+    for field in fields:
+        check_field(meta, field)
+
+    return fields
+
+
+def check_field(meta, field):
+    if field not in default_fields and not meta.has_field(field):
+        frappe.throw(_("Field {0} not found in {1}").format(field, meta.name))
+
+
+def get_target_conditions(target) -> tuple:
+    """WHERE conditions for the target's filters and their query parameters.
+
+    Every filter field is matched against its value with the target's
+    `filter_operator`; values are always passed as parameters.
+    """
+    filter_fields = [f.strip() for f in (target.filter_fields or "").split(",") if f.strip()]
+    values = [v.strip() for v in (target.fields_values or "").split(",")]
+    if not filter_fields or len(filter_fields) != len(values):
+        return [], {}
+
+    meta = frappe.get_meta(target.reference)
+    operator = target.get("filter_operator") or "Equals"
+
+    conditions = []
+    params = {}
+    for i, (field, value) in enumerate(zip(filter_fields, values)):
+        check_field(meta, field)
+        key = f"filter_{i}"
+
+        if operator == "Starts With":
+            conditions.append(f"`{field}` LIKE %({key})s")
+            params[key] = f"{escape_like(value)}%"
+        elif operator == "In":
+            conditions.append(f"`{field}` IN %({key})s")
+            params[key] = tuple(v.strip() for v in value.split("|") if v.strip()) or ("",)
+        elif operator == "Contains":
+            conditions.append(f"`{field}` LIKE %({key})s")
+            params[key] = f"%{escape_like(value)}%"
+        else:
+            conditions.append(f"`{field}` = %({key})s")
+            params[key] = value
+
+    return conditions, params
+
+
+def escape_like(value) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def compile_target_query(target, fields, conditions=(), values=None, limit=None) -> tuple:
+    """Parameterized SELECT of the target's rows (with `name`), ordered by name.
+
+    `conditions` and `values` are ANDed to the target's own filters; the
+    reference index uses them to page through and re-read rows by name.
+    """
+    where, params = get_target_conditions(target)
+    where.extend(conditions)
+    params.update(values or {})
+
+    columns = ", ".join(f"`{field}`" for field in dict.fromkeys(["name", *fields]))
+    query = f"SELECT {columns} FROM `tab{target.reference}`"
+    if where:
+        query += f" WHERE {' AND '.join(where)}"
+    query += " ORDER BY `name`"
+    if limit:
+        query += f" LIMIT {cint(limit)}"
+
+    return query, params
+
+
+def get_target_rows(target, fields, agent_name=None) -> list:
+    """The target's rows, up to its `row_limit`.
+
+    Given an agent, the rows are cached for it until the target doctype
+    changes (see `reference_sync`), so documents sharing a target reuse them.
+    """
+    row_limit = target.get("row_limit")
+    row_limit = DEFAULT_ROW_LIMIT if row_limit is None else cint(row_limit)
+
+    query, params = compile_target_query(target, fields, limit=row_limit)
+    if not agent_name:
+        return frappe.db.sql(query, params, as_dict=True)
+
+    key = get_result_key(agent_name, target.reference, query, params)
+    rows = frappe.cache().get_value(key)
+    if rows is None:
+        rows = frappe.db.sql(query, params, as_dict=True)
+        if len(rows) <= MAX_CACHED_ROWS:
+            frappe.cache().set_value(key, rows, expires_in_sec=RESULT_CACHE_TTL)
+
+    return rows
+
+
+def get_result_key(agent_name, doctype, query, params) -> str:
+    digest = hashlib.sha1(json.dumps([query, params], sort_keys=True, default=str).encode()).hexdigest()
+    return f"ai_reference_rows|{agent_name}|{get_reference_version(doctype)}|{digest}"
+
+
+def get_reference_version(doctype) -> str:
+    return frappe.cache().get_value(f"ai_reference_version|{doctype}") or "0"
+
+
+def bump_reference_version(doctype):
+    """Make every cached result over `doctype` stale; the old entries expire on their own."""
+    frappe.cache().set_value(f"ai_reference_version|{doctype}", frappe.generate_hash(length=10))
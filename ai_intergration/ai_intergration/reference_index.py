@@ -0,0 +1,392 @@
+"""Per-agent retrieval index over the rows of an AI Agent's reference targets.
+
+Each target gets a BM25 index over its configured `fields`, optionally fused
+with embeddings from an `ai_reference_embedder` hook:
+
+    # hooks.py of any installed app
+    ai_reference_embedder = "my_app.embeddings.embed"
+
+    def embed(texts: list) -> list:  # one vector per text
+        ...
+
+Indexes are only ever built in background jobs and stored as one file per
+agent under the site's private folder; requests just load and query them.
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import os
+import pickle
+import re
+from collections import Counter, OrderedDict, defaultdict
+
+import frappe
+from frappe.utils import cint
+
+
+INDEX_FOLDER = "ai_reference_index"
+# Retrieval is opt-in per agent: 0 sends every row and builds no index
+DEFAULT_TOP_K = 0
+
+PAGE_SIZE = 5000
+
+# Every writer of an agent's index holds its lock from load (or first read) to save
+LOCK_TIMEOUT = 60 * 60
+EMBED_BATCH_SIZE = 256
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Reciprocal rank fusion constant used to merge BM25 and embedding rankings
+RRF_K = 60
+
+TOKEN = re.compile(r"\w+")
+
+# Loaded indexes kept per process, least recently used evicted first. The
+# newest one is always kept, however many rows it has.
+MAX_LOADED_INDEXES = 8
+MAX_LOADED_ROWS = 500_000
+
+# agent name -> (file mtime, AgentIndex, rows), per process
+_loaded = OrderedDict()
+
+
+class TargetIndex:
+    """BM25 over the rows of one reference target, keyed by document name."""
+
+    def __init__(self, doctype, fields):
+        self.doctype = doctype
+        self.fields = fields
+        self.rows = {}
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        self.total_length = 0
+        self.vectors = {}
+        self._matrix = None
+
+    def add(self, name, row: dict, vector=None):
+        if name in self.rows:
+            self.remove(name)
+
+        values = [row.get(f) for f in self.fields]
+        terms = Counter(tokenize(" ".join(str(v) for v in values if v is not None)))
+
+        self.rows[name] = values
+        self.lengths[name] = sum(terms.values())
+        self.total_length += self.lengths[name]
+        for term, tf in terms.items():
+            self.postings[term][name] = tf
+
+        if vector is not None:
+            self.vectors[name] = normalize(vector)
+            self._matrix = None
+
+    def remove(self, name):
+        values = self.rows.pop(name, None)
+        if values is None:
+            return
+
+        for term in set(tokenize(" ".join(str(v) for v in values if v is not None))):
+            postings = self.postings.get(term)
+            if postings is not None:
+                postings.pop(name, None)
+                if not postings:
+                    del self.postings[term]
+
+        self.total_length -= self.lengths.pop(name)
+        if self.vectors.pop(name, None) is not None:
+            self._matrix = None
+
+    def search(self, query: str, k: int, query_vector=None) -> list:
+        """Names of the `k` rows that best match `query`, best first."""
+        if query_vector is None or not self.vectors:
+            return self.rank_bm25(query, k)
+
+        # Each ranking contributes its best candidates to the fused ranking
+        candidates = max(k * 10, 100)
+        return fuse(self.rank_bm25(query, candidates), self.rank_vectors(query_vector, candidates))[:k]
+
+    def rank_bm25(self, query, limit) -> list:
+        count = len(self.rows)
+        if not count:
+            return []
+
+        avg_length = self.total_length / count or 1
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for name, tf in postings.items():
+                norm = 1 - BM25_B + BM25_B * self.lengths[name] / avg_length
+                scores[name] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * norm)
+
+        return heapq.nlargest(limit, scores, key=scores.get)
+
+    def rank_vectors(self, query_vector, limit) -> list:
+        import numpy as np
+
+        if self._matrix is None:
+            names = list(self.vectors)
+            self._matrix = (names, np.vstack([self.vectors[name] for name in names]))
+
+        names, matrix = self._matrix
+        scores = matrix @ normalize(query_vector)
+        return [names[i] for i in np.argsort(-scores, kind="stable")[:limit]]
+
+    def __getstate__(self):
+        # The stacked matrix is rebuilt on first use after loading
+        return {**self.__dict__, "_matrix": None}
+
+
+class AgentIndex:
+    def __init__(self, agent_name):
+        self.agent = agent_name
+        # target signature -> TargetIndex
+        self.targets = {}
+
+
+def tokenize(text) -> list:
+    return [t for t in TOKEN.findall(str(text).lower()) if len(t) > 1 or t.isdigit()]
+
+
+def normalize(vector):
+    import numpy as np
+
+    vector = np.asarray(vector, dtype=np.float32)
+    length = np.linalg.norm(vector)
+    return vector / length if length else vector
+
+
+def fuse(*rankings) -> list:
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, name in enumerate(ranking):
+            scores[name] += 1 / (RRF_K + rank + 1)
+
+    return sorted(scores, key=lambda name: (-scores[name], name))
+
+
+def get_top_k(agent) -> int:
+    top_k = agent.get("reference_top_k")
+    return DEFAULT_TOP_K if top_k is None else cint(top_k)
+
+
+def get_embedder():
+    hooks = frappe.get_hooks("ai_reference_embedder")
+    return frappe.get_attr(hooks[-1]) if hooks else None
+
+
+def get_target_signature(target) -> str:
+    """Changes whenever a change to the target would change its index."""
+    from ai_intergration.ai_intergration.reference_context import get_target_fields
+
+    embedder = frappe.get_hooks("ai_reference_embedder")
+    key = json.dumps([
+        target.reference,
+        get_target_fields(target),
+        target.filter_fields or "",
+        target.fields_values or "",
+        target.get("filter_operator") or "Equals",
+        embedder[-1] if embedder else None,
+    ])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def get_index_path(agent_name) -> str:
+    digest = hashlib.sha1(agent_name.encode()).hexdigest()
+    return frappe.get_site_path("private", INDEX_FOLDER, f"{digest}.pkl")
+
+
+def load_index(agent_name):
+    """The agent's stored index, reloaded only when its file changed."""
+    path = get_index_path(agent_name)
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        _loaded.pop(agent_name, None)
+        return None
+
+    cached = _loaded.get(agent_name)
+    if cached and cached[0] == mtime:
+        _loaded.move_to_end(agent_name)
+        return cached[1]
+
+    # Dropped before loading, so the stale copy and the new one are never both held
+    _loaded.pop(agent_name, None)
+    with open(path, "rb") as f:
+        index = pickle.load(f)
+
+    _loaded[agent_name] = (mtime, index, sum(len(t.rows) for t in index.targets.values()))
+    evict_loaded_indexes()
+    return index
+
+
+def evict_loaded_indexes():
+    rows = sum(cached[2] for cached in _loaded.values())
+    while len(_loaded) > 1 and (len(_loaded) > MAX_LOADED_INDEXES or rows > MAX_LOADED_ROWS):
+        _, (_, _, evicted_rows) = _loaded.popitem(last=False)
+        rows -= evicted_rows
+
+
+def save_index(index):
+    path = get_index_path(index.agent)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f"{path}.{frappe.generate_hash(length=8)}"
+    try:
+        with open(tmp_path, "wb") as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def search_target(agent, target, query, top_k):
+    """Top rows of `target` for `query` as lists of field values, or None if it has no up-to-date index."""
+    index = load_index(agent.name) if agent.name else None
+    target_index = index and index.targets.get(get_target_signature(target))
+    if target_index is None:
+        if agent.name:
+            enqueue_build(agent.name)
+        return None
+
+    query_vector = None
+    embedder = get_embedder() if target_index.vectors else None
+    if embedder:
+        query_vector = embedder([query])[0]
+
+    return [target_index.rows[name] for name in target_index.search(query, top_k, query_vector)]
+
+
+def enqueue_build(agent_name):
+    frappe.enqueue(
+        "ai_intergration.ai_intergration.reference_index.build_agent_index",
+        queue="long",
+        job_id=f"ai_reference_index|{frappe.local.site}|{agent_name}",
+        deduplicate=True,
+        agent_name=agent_name,
+    )
+
+
+def get_index_lock(agent_name, blocking_timeout=None):
+    """Redis lock serializing every writer of an agent's index file."""
+    cache = frappe.cache()
+    return cache.lock(
+        cache.make_key(f"ai_reference_index_lock|{agent_name}"),
+        timeout=LOCK_TIMEOUT,
+        blocking_timeout=blocking_timeout,
+    )
+
+
+def build_agent_index(agent_name):
+    """Background job: (re)build every reference-target index of an agent.
+
+    The lock is held while rows are read, so incremental updates wait and
+    are applied on top of the new index instead of being overwritten by it.
+    """
+    agent = frappe.get_doc("AI Agent", agent_name)
+
+    with get_index_lock(agent_name):
+        if not get_top_k(agent) or not agent.reference_targets:
+            delete_index(agent_name)
+            return
+
+        index = AgentIndex(agent_name)
+        for target in agent.reference_targets:
+            signature = get_target_signature(target)
+            if signature not in index.targets:
+                index.targets[signature] = build_target_index(target)
+
+        save_index(index)
+
+    frappe.logger("ai_intergration").info({
+        "event": "ai_reference_index_built",
+        "agent": agent_name,
+        "rows": sum(len(t.rows) for t in index.targets.values()),
+    })
+
+
+def build_target_index(target) -> TargetIndex:
+    from ai_intergration.ai_intergration.reference_context import compile_target_query, get_target_fields
+
+    fields = get_target_fields(target)
+    target_index = TargetIndex(target.reference, fields)
+    embedder = get_embedder()
+
+    last_name = None
+    while True:
+        # Keyset pagination: every page is an index range scan on `name`
+        query, params = compile_target_query(
+            target,
+            fields,
+            conditions=["`name` > %(after)s"] if last_name else [],
+            values={"after": last_name},
+            limit=PAGE_SIZE,
+        )
+        rows = frappe.db.sql(query, params, as_dict=True)
+        if not rows:
+            break
+
+        vectors = [None] * len(rows)
+        if embedder:
+            vectors = []
+            for i in range(0, len(rows), EMBED_BATCH_SIZE):
+                batch = rows[i:i + EMBED_BATCH_SIZE]
+                vectors.extend(embedder([get_row_text(row, fields) for row in batch]))
+
+        for row, vector in zip(rows, vectors):
+            target_index.add(row.name, row, vector)
+
+        last_name = rows[-1].name
+
+    return target_index
+
+
+def get_row_text(row, fields) -> str:
+    return " ".join(str(row.get(f)) for f in fields if row.get(f) is not None)
+
+
+def delete_index(agent_name):
+    _loaded.pop(agent_name, None)
+    try:
+        os.remove(get_index_path(agent_name))
+    except FileNotFoundError:
+        pass
+
+
+def rebuild_indexes():
+    """Scheduled job: rebuild the index of every agent that uses retrieval."""
+    for agent in frappe.get_all("AI Agent", filters={"reference_top_k": [">", 0]}, pluck="name"):
+        enqueue_build(agent)
+
+
+def on_agent_update(doc, method=None):
+    if not get_top_k(doc) or not doc.reference_targets:
+        # The build job deletes it, under the index lock
+        if os.path.exists(get_index_path(doc.name)):
+            enqueue_build(doc.name)
+        return
+
+    index = load_index(doc.name)
+    if index is None or any(get_target_signature(t) not in index.targets for t in doc.reference_targets):
+        enqueue_build(doc.name)
+
+
+def on_agent_trash(doc, method=None):
+    frappe.enqueue(
+        "ai_intergration.ai_intergration.reference_index.remove_agent_index",
+        queue="long",
+        enqueue_after_commit=True,
+        agent_name=doc.name,
+    )
+
+
+def remove_agent_index(agent_name):
+    """Background job: delete a removed agent's index once no writer holds it."""
+    with get_index_lock(agent_name):
+        delete_index(agent_name)
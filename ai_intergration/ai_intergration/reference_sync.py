@@ -0,0 +1,201 @@
+"""Keep AI Agent reference indexes and cached target rows in step with the documents they cover.
+
+`hooks.py` routes every document event here (`"*"` doc_events); documents of
+doctypes no agent references are dropped after one cached lookup. Cached
+target rows are invalidated by a per-doctype version bump, repeated after
+commit. Index changes are collected in a Redis set and applied by a single
+deduplicated job, so a bulk import of thousands of documents costs one job
+that re-reads only the changed rows.
+"""
+
+import json
+
+import frappe
+
+from ai_intergration.ai_intergration.reference_context import bump_reference_version, compile_target_query
+from ai_intergration.ai_intergration.reference_index import (
+    get_embedder,
+    get_index_lock,
+    get_row_text,
+    get_target_signature,
+    load_index,
+    save_index,
+)
+
+
+DOCTYPES_KEY = "ai_reference_doctypes"
+CHANGES_KEY = "ai_reference_changes"
+PROCESSING_KEY = "ai_reference_changes|processing"
+
+# Changed rows re-read from the database per query
+BATCH_SIZE = 500
+
+# Seconds to wait for an agent's index lock, e.g. while its index is rebuilt
+LOCK_WAIT = 5 * 60
+
+
+def get_referenced_doctypes() -> dict:
+    """Referenced doctype -> names of the agents with a reference target on it."""
+    return frappe.cache().get_value(DOCTYPES_KEY, generator=load_referenced_doctypes)
+
+
+def load_referenced_doctypes() -> dict:
+    doctypes = {}
+    for row in frappe.get_all(
+        "Reference Targets Table",
+        filters={"parenttype": "AI Agent"},
+        fields=["parent", "reference"],
+    ):
+        if row.reference:
+            doctypes.setdefault(row.reference, set()).add(row.parent)
+
+    return {doctype: sorted(names) for doctype, names in doctypes.items()}
+
+
+def on_agent_change(doc, method=None):
+    frappe.cache().delete_value(DOCTYPES_KEY)
+
+
+def on_document_change(doc, method=None, *args, **kwargs):
+    # Tables may not exist yet; the daily rebuild catches up on anything skipped
+    if frappe.flags.in_install or frappe.flags.in_migrate:
+        return
+
+    if doc.doctype not in get_referenced_doctypes():
+        return
+
+    # Cached target rows go stale at once, and again after commit: a read
+    # between the two bumps may have cached the rows from before this change
+    bump_reference_version(doc.doctype)
+    bump_after_commit(doc.doctype)
+
+    names = [doc.name]
+    if method == "after_rename":
+        # after_rename(doc, method, old, new, merge): the old name's entry goes away
+        names.append(args[0])
+
+    frappe.cache().sadd(CHANGES_KEY, *(json.dumps([doc.doctype, name]) for name in names))
+    enqueue_apply_changes(after_commit=True)
+
+
+def bump_after_commit(doctype):
+    # Once per doctype and transaction, however many of its documents change
+    pending = frappe.flags.setdefault("ai_reference_version_bumps", set())
+    if doctype in pending:
+        return
+
+    pending.add(doctype)
+
+    def bump():
+        pending.discard(doctype)
+        bump_reference_version(doctype)
+
+    frappe.db.after_commit.add(bump)
+    frappe.db.after_rollback.add(lambda: pending.discard(doctype))
+
+
+def enqueue_apply_changes(after_commit=False):
+    """Queue `apply_changes` under the one job id it ever runs with, so runs never overlap."""
+    frappe.enqueue(
+        "ai_intergration.ai_intergration.reference_sync.apply_changes",
+        queue="short",
+        job_id=f"ai_reference_sync|{frappe.local.site}",
+        deduplicate=True,
+        enqueue_after_commit=after_commit,
+    )
+
+
+def sweep_changes():
+    """Scheduled job: pick up changes left by a run that was skipped or failed."""
+    # RedisWrapper.exists makes the keys itself
+    if frappe.cache().exists(CHANGES_KEY, PROCESSING_KEY):
+        enqueue_apply_changes()
+
+
+def apply_changes():
+    """Background job: apply every pending change to the affected indexes.
+
+    Pending changes are claimed in one transaction by moving them to a
+    processing set, so a change recorded while this runs lands in a fresh
+    pending set for the next run. The processing set is only deleted once
+    applied; a run that fails leaves it to be retried with the next claim.
+    """
+    cache = frappe.cache()
+    pipeline = cache.pipeline()
+    pipeline.sunionstore(cache.make_key(PROCESSING_KEY), [cache.make_key(PROCESSING_KEY), cache.make_key(CHANGES_KEY)])
+    pipeline.delete(cache.make_key(CHANGES_KEY))
+    pipeline.execute()
+
+    members = cache.smembers(PROCESSING_KEY)
+    if not members:
+        return
+
+    changed = {}
+    for member in members:
+        doctype, name = json.loads(member)
+        changed.setdefault(doctype, set()).add(name)
+
+    referenced = get_referenced_doctypes()
+    agents = {agent for doctype in changed for agent in referenced.get(doctype, [])}
+
+    for agent_name in sorted(agents):
+        update_agent_index(agent_name, changed)
+
+    cache.delete_value(PROCESSING_KEY)
+
+
+def update_agent_index(agent_name, changed: dict):
+    # A running build holds the lock; if it is not released in time the job
+    # fails and the claimed changes are retried by the next run
+    with get_index_lock(agent_name, blocking_timeout=LOCK_WAIT):
+        index = load_index(agent_name)
+        if index is None:
+            # Not built yet (the build reads every row anyway), or the agent does not use retrieval
+            return
+
+        agent = frappe.get_cached_doc("AI Agent", agent_name)
+
+        updated = 0
+        for target in agent.reference_targets:
+            names = changed.get(target.reference)
+            target_index = names and index.targets.get(get_target_signature(target))
+            if not target_index:
+                continue
+
+            updated += update_target_index(target, target_index, sorted(names))
+
+        if updated:
+            save_index(index)
+
+            frappe.logger("ai_intergration").info({
+                "event": "ai_reference_index_updated",
+                "agent": agent_name,
+                "rows": updated,
+            })
+
+
+def update_target_index(target, target_index, names) -> int:
+    embedder = get_embedder()
+
+    for i in range(0, len(names), BATCH_SIZE):
+        batch = names[i:i + BATCH_SIZE]
+        query, params = compile_target_query(
+            target,
+            target_index.fields,
+            conditions=["`name` IN %(names)s"],
+            values={"names": tuple(batch)},
+        )
+        rows = frappe.db.sql(query, params, as_dict=True)
+
+        vectors = [None] * len(rows)
+        if embedder and rows:
+            vectors = embedder([get_row_text(row, target_index.fields) for row in rows])
+
+        # Deleted, renamed away or no longer matching the target's filters
+        for name in set(batch) - {row.name for row in rows}:
+            target_index.remove(name)
+
+        for row, vector in zip(rows, vectors):
+            target_index.add(row.name, row, vector)
+
+    return len(names)
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import cint, get_url
+
+from ai_intergration.ai_intergration.llm_clients import get_openai_client
+
+
+CHUNK_SIZE = 64 * 1024
+
+TTS_FOLDER = "ai_tts"
+DEFAULT_TTS_CACHE_SIZE = 500  # MB
+
+TRANSCRIPT_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Audio longer than this is split on silences into chunks of about this length
+CHUNK_SECONDS = 60
+# Silences are looked for this far before a chunk boundary; failing that the cut is made there
+SPLIT_WINDOW_SECONDS = 15
+MAX_TRANSCRIBE_WORKERS = 4
+
+SILENCE_END = re.compile(r"silence_end: ([\d.]+) \| silence_duration: ([\d.]+)")
+DURATION = re.compile(r"Duration: (\d+):(\d+):([\d.]+)")
+
+
+def get_tts_folder() -> str:
+    return frappe.get_site_path("public", "files", TTS_FOLDER)
+
+
+def synthesize_speech(model: str, client_credentials, text: str, voice: str="alloy") -> str:
+    """Public URL of the speech for `text`, synthesized once per (model, voice, text).
+
+    Cached files are named by that key. New audio is streamed to a temporary
+    file in chunks and renamed into place, so concurrent calls never see or
+    leave a partial file. A cache hit refreshes the file's mtime, which the
+    eviction job uses as last-used time.
+    """
+    key = hashlib.sha256(f"{model}|{voice}|{text}".encode()).hexdigest()
+    file_name = f"{key}.mp3"
+    path = os.path.join(get_tts_folder(), file_name)
+
+    if os.path.exists(path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted in between
+            pass
+        else:
+            return get_url(f"/files/{TTS_FOLDER}/{file_name}")
+
+    os.makedirs(get_tts_folder(), exist_ok=True)
+    tmp_path = f"{path}.{frappe.generate_hash(length=8)}"
+
+    ai_client = get_openai_client(client_credentials)
+    try:
+        with ai_client.audio.speech.with_streaming_response.create(
+            model=model,
+            voice=voice,
+            input=text,
+        ) as response:
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_bytes(CHUNK_SIZE):
+                    f.write(chunk)
+
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return get_url(f"/files/{TTS_FOLDER}/{file_name}")
+
+
+def evict_tts_cache():
+    """Scheduled job: delete the least recently used TTS files beyond the size cap."""
+    settings = frappe.get_cached_doc("Ai Settings", "Ai Settings")
+    cache_size = settings.get("tts_cache_size")
+    max_bytes = (DEFAULT_TTS_CACHE_SIZE if cache_size is None else cint(cache_size)) * 1024 * 1024
+
+    folder = get_tts_folder()
+    if not os.path.isdir(folder):
+        return
+
+    entries = []
+    for entry in os.scandir(folder):
+        # Audio still being streamed in is named `<key>.mp3.<hash>`
+        if entry.is_file() and entry.name.endswith(".mp3"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+        total -= size
+        removed += 1
+
+    if removed:
+        frappe.logger("ai_intergration").info({"event": "ai_tts_evicted", "files": removed, "bytes_left": total})
+
+
+def transcribe_audio(model: str, client_credentials, file_name: str, audio_data) -> str:
+    """Transcript of a voice note, cached by the hash of its bytes.
+
+    With ffmpeg available the audio is transcoded to 16 kHz mono Opus and, when
+    longer than `CHUNK_SECONDS`, cut at silences into chunks that are
+    transcribed concurrently and joined in order. Without ffmpeg it is sent
+    as it is, in one request.
+    """
+    with tempfile.TemporaryDirectory(prefix="ai-stt-") as tmp_dir:
+        source_path = os.path.join(tmp_dir, f"source{os.path.splitext(file_name)[1]}")
+
+        digest = hashlib.sha256()
+        with audio_data as src, open(source_path, "wb") as f:
+            src.seek(0)
+            while chunk := src.read(CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+
+        cache_key = f"ai_transcript|{model}|{digest.hexdigest()}"
+        transcript = frappe.cache().get_value(cache_key)
+        if transcript is not None:
+            return transcript
+
+        ai_client = get_openai_client(client_credentials)
+
+        chunk_paths = [source_path]
+        if shutil.which("ffmpeg"):
+            try:
+                chunk_paths = split_audio(source_path, tmp_dir)
+            except subprocess.CalledProcessError as e:
+                frappe.logger("ai_intergration").warning({"event": "ai_stt_transcode_failed", "error": e.stderr[-500:]})
+
+        def transcribe(path):
+            with open(path, "rb") as f:
+                return ai_client.audio.transcriptions.create(model=model, file=f).text
+
+        if len(chunk_paths) == 1:
+            texts = [transcribe(chunk_paths[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(MAX_TRANSCRIBE_WORKERS, len(chunk_paths))) as executor:
+                texts = list(executor.map(transcribe, chunk_paths))
+
+    transcript = " ".join(t.strip() for t in texts if t and t.strip())
+    frappe.cache().set_value(cache_key, transcript, expires_in_sec=TRANSCRIPT_CACHE_TTL)
+
+    return transcript
+
+
+def split_audio(source_path, tmp_dir) -> list:
+    """Transcode to Opus and cut it at silences near every `CHUNK_SECONDS`; returns the chunk paths in order."""
+    audio_path = os.path.join(tmp_dir, "audio.ogg")
+    output = run_ffmpeg(
+        "-i", source_path,
+        "-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k",
+        "-af", "silencedetect=noise=-35dB:d=0.4",
+        audio_path,
+    )
+
+    duration = get_duration(output)
+    if not duration or duration <= CHUNK_SECONDS:
+        return [audio_path]
+
+    # Middle of each silence is a cut candidate
+    silences = [float(end) - float(length) / 2 for end, length in SILENCE_END.findall(output)]
+
+    cuts = []
+    start = 0.0
+    while duration - start > CHUNK_SECONDS:
+        target = start + CHUNK_SECONDS
+        candidates = [t for t in silences if target - SPLIT_WINDOW_SECONDS <= t <= target]
+        cut = max(candidates) if candidates else target
+        cuts.append(cut)
+        start = cut
+
+    paths = []
+    bounds = [0.0, *cuts, None]
+    for i, (chunk_start, chunk_end) in enumerate(zip(bounds, bounds[1:])):
+        path = os.path.join(tmp_dir, f"chunk-{i:03d}.ogg")
+        args = ["-ss", f"{chunk_start:.3f}"]
+        if chunk_end is not None:
+            args += ["-to", f"{chunk_end:.3f}"]
+
+        run_ffmpeg("-i", audio_path, *args, "-c", "copy", path)
+        paths.append(path)
+
+    return paths
+
+
+def run_ffmpeg(*args) -> str:
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostdin", "-y", *args],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stderr
+
+
+def get_duration(ffmpeg_output):
+    match = DURATION.search(ffmpeg_output)
+    if not match:
+        return None
+
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
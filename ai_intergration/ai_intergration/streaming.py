@@ -0,0 +1,125 @@
+import json
+import time
+
+import frappe
+
+
+DELTA_EVENT = "ai_chat_delta"
+DONE_EVENT = "ai_chat_done"
+
+
+class ReplyStream:
+    """Times a chat turn and, when publishing, pushes reply deltas to the chat's room.
+
+    A stream that does not publish is falsy, so providers fall back to a
+    blocking call when they get one. With `publish_deltas` off only the final
+    result is published, for replies whose deltas are not reply text.
+    """
+
+    def __init__(self, chat_id, publish=True, publish_deltas=True):
+        self.chat_id = chat_id
+        self.publish = publish
+        self.publish_deltas = publish_deltas
+        self.started_at = time.perf_counter()
+        self.first_token_at = None
+        self.finished_at = None
+
+    def __bool__(self):
+        return bool(self.publish)
+
+    def push(self, delta):
+        if not delta:
+            return
+
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+        if self.publish and self.publish_deltas:
+            frappe.publish_realtime(
+                DELTA_EVENT,
+                {"chat": self.chat_id, "delta": delta},
+                doctype="Ai Chat",
+                docname=self.chat_id,
+            )
+
+    def finish(self, response=None):
+        self.finished_at = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = self.finished_at
+
+        if self.publish:
+            frappe.publish_realtime(
+                DONE_EVENT,
+                {"chat": self.chat_id, "response": response, "metrics": self.get_metrics()},
+                doctype="Ai Chat",
+                docname=self.chat_id,
+                after_commit=True,
+            )
+
+    def get_metrics(self) -> dict:
+        end = self.finished_at or time.perf_counter()
+        first = self.first_token_at or end
+
+        return {
+            "first_token_ms": int((first - self.started_at) * 1000),
+            "response_ms": int((end - self.started_at) * 1000),
+        }
+
+
+def create_openai_response(ai_client, stream: ReplyStream = None, **kwargs):
+    """`responses.create` that forwards text deltas to `stream` and returns the final response.
+
+    While the model may still call tools, a message's text is held until the
+    message item is done and pushed only if no function call has shown up in
+    the response by then: text beside a tool call is not the reply.
+    """
+    if not stream:
+        return ai_client.responses.create(**kwargs)
+
+    hold = bool(kwargs.get("tools")) and kwargs.get("tool_choice") != "none"
+    held = []
+    calls_tools = False
+
+    response = None
+    for event in ai_client.responses.create(stream=True, **kwargs):
+        if event.type == "response.output_text.delta":
+            if hold:
+                held.append(event.delta)
+            else:
+                stream.push(event.delta)
+        elif event.type == "response.output_item.added" and event.item.type == "function_call":
+            calls_tools = True
+            held.clear()
+        elif event.type == "response.output_item.done" and event.item.type == "message":
+            if held and not calls_tools:
+                stream.push("".join(held))
+            held.clear()
+        elif event.type in ("response.completed", "response.incomplete"):
+            response = event.response
+        elif event.type == "response.failed":
+            raise Exception(str(event.response.error))
+
+    return response
+
+
+def read_ollama_stream(chunks, stream: ReplyStream) -> dict:
+    """Collect Ollama `/chat` stream chunks into a single message."""
+    role = "assistant"
+    parts = []
+    last = {}
+
+    for chunk in chunks:
+        if isinstance(chunk, (bytes, str)):
+            if not chunk:
+                continue
+            chunk = json.loads(chunk)
+
+        message = chunk.get("message") or {}
+        role = message.get("role") or role
+        delta = message.get("content") or ""
+
+        parts.append(delta)
+        stream.push(delta)
+        last = chunk
+
+    return {"role": role, "content": "".join(parts), "done": dict(last)}
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import frappe
+from frappe.utils import cint
+
+from ai_intergration.ai_intergration.llm_clients import get_http_session
+
+
+MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 30
+
+
+def get_tool_spec(src) -> dict:
+    """Everything needed to call an Ai Data Source without touching the DB."""
+    if isinstance(src, str):
+        src = frappe.get_doc("Ai Data Source", src)
+
+    return {
+        "name": src.name,
+        "url": src.url,
+        "method": src.method or "GET",
+        "headers": src.get_headers(),
+        "timeout": cint(src.get("timeout")) or DEFAULT_TIMEOUT,
+    }
+
+
+def call_tool(session, spec, args, started=None):
+    if started is not None:
+        started.started_at = time.monotonic()
+        started.set()
+
+    try:
+        if spec["method"] == "GET":
+            res = session.get(spec["url"], headers=spec["headers"], params=args, timeout=spec["timeout"])
+        else:
+            res = session.request(spec["method"], spec["url"], headers=spec["headers"], json=args, timeout=spec["timeout"])
+        res.raise_for_status()
+        response_json = res.json()
+
+        return json.dumps(response_json)
+
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def get_timeout_error(spec):
+    return {
+        "error": "timeout",
+        "tool": spec["name"],
+        "message": f"The {spec['name']} tool did not respond within {spec['timeout']} seconds.",
+    }
+
+
+def execute_tool_calls(calls: list, specs: dict = None) -> list:
+    """Run `(name, arguments)` calls concurrently and return their outputs in call order.
+
+    Each call is bounded by its data source's timeout, counted from when a
+    worker picks it up; a call that runs over, or waits that long for a
+    worker, gets a structured error instead of blocking the turn.
+    """
+    if not calls:
+        return []
+
+    specs = dict(specs or {})
+    for name, _ in calls:
+        if name not in specs:
+            specs[name] = get_tool_spec(name)
+
+    session = get_http_session("tools")
+    executor = ThreadPoolExecutor(max_workers=min(len(calls), MAX_WORKERS))
+
+    try:
+        started = [threading.Event() for _ in calls]
+        futures = [
+            executor.submit(call_tool, session, specs[name], args, event)
+            for (name, args), event in zip(calls, started)
+        ]
+
+        results = []
+        for (name, _), future, event in zip(calls, futures, started):
+            spec = specs[name]
+
+            try:
+                # Calls past the pool size queue until an earlier one finishes
+                if not event.wait(timeout=spec["timeout"]):
+                    future.cancel()
+                    raise TimeoutError
+
+                remaining = spec["timeout"] - (time.monotonic() - event.started_at)
+                result = future.result(timeout=max(remaining, 0))
+            except TimeoutError:
+                result = get_timeout_error(spec)
+
+            if isinstance(result, dict):
+                frappe.log_error(f"AI Request failed: {result.get('message') or result.get('error')}", "AI Agent Tool Error")
+
+            results.append(result)
+
+        return results
+
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
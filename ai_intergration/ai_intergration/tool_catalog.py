@@ -0,0 +1,109 @@
+import frappe
+
+from ai_intergration.ai_intergration.tool_calls import get_tool_spec
+
+
+CACHE_KEY = "ai_tool_catalog"
+
+EMPTY_CATALOG = {"tools": [], "request_types": "", "specs": {}}
+
+
+def get_catalog(source_template) -> dict:
+    """Return the compiled catalog of an Ai Data Source Template, shared by all workers.
+
+    The catalog holds the Responses API tool list (v2), the request-type
+    prompt block (v1) and the call specs used to execute the tools.
+    """
+    if not source_template:
+        return EMPTY_CATALOG
+
+    catalog = frappe.cache().hget(CACHE_KEY, source_template)
+    if catalog is None:
+        catalog = compile_catalog(source_template)
+
+    return catalog
+
+
+def compile_catalog(source_template) -> dict:
+    template = frappe.get_doc("Ai Data Source Template", source_template)
+
+    tools = []
+    request_types = []
+    specs = {}
+    for s in template.data_source_table:
+        src = frappe.get_doc("Ai Data Source", s.source)
+
+        tools.append(get_tool(src))
+        request_types.append(get_request_type(src))
+        specs[src.name] = get_tool_spec(src)
+
+    catalog = {
+        "tools": tools,
+        "request_types": ",\n".join(request_types),
+        "specs": specs,
+    }
+
+    frappe.cache().hset(CACHE_KEY, source_template, catalog)
+    return catalog
+
+
+def get_tool(src) -> dict:
+    props, required_props = src.get_properties()
+
+    return {
+        "type": "function",
+        "name": src.name,
+        "description": f"{src.when}. This function calls the {src.method} {src.url} API.",
+        "parameters": {
+            "type": "object",
+            "properties": props,
+            "required": required_props,
+            "additionalProperties": False,
+        },
+        "strict": True
+    }
+
+
+def get_request_type(src) -> str:
+    return f"""{{
+        "when": "{src.when.strip() if src.when else ""}",
+        "method": "{src.method.strip()}",
+        "url": "{src.get_full_url()}",
+        "body": {src.get_json_body()},
+        "auth_type": "{src.auth_type.strip() if src.auth_type else ""}",
+        "auth_token": "{src.auth_token.strip() if src.auth_token else ""}",
+        "instructions": "{src.instructions.strip() if src.instructions else ""}"
+    }}"""
+
+
+def recompile_template(doc, method=None):
+    """doc_events handler for `Ai Data Source Template`."""
+    if method == "on_trash":
+        frappe.cache().hdel(CACHE_KEY, doc.name)
+        return
+
+    _recompile(doc.name)
+
+
+def recompile_source_templates(doc, method=None):
+    """doc_events handler for `Ai Data Source`: recompile every template using it."""
+    templates = frappe.get_all(
+        "Ai Data Source Table",
+        filters={"source": doc.name, "parenttype": "Ai Data Source Template"},
+        pluck="parent",
+        distinct=True,
+    )
+
+    for template in templates:
+        if method == "on_trash":
+            frappe.cache().hdel(CACHE_KEY, template)
+        else:
+            _recompile(template)
+
+
+def _recompile(source_template):
+    try:
+        compile_catalog(source_template)
+    except Exception:
+        # Compiled again on first use
+        frappe.cache().hdel(CACHE_KEY, source_template)
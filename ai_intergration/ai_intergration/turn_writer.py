@@ -0,0 +1,205 @@
+import time
+
+import frappe
+from frappe.utils import now_datetime
+
+from ai_intergration.ai_intergration.message_store import (
+    BOTH,
+    CHAT_TABLE,
+    append_chat_messages,
+    get_field_value,
+    is_chat_table_storage,
+)
+
+
+MESSAGE_FIELDS = (
+    "chat",
+    "role",
+    "content",
+    "message_text",
+    "type",
+    "image",
+    "timestamp",
+    "responded_to",
+    "response_type",
+    "first_token_ms",
+    "response_ms",
+    "channel_type",
+    "whatsapp_instance",
+    "instagram_instance",
+)
+
+# Fetched from the chat, as `fetch_from` would on insert
+CHAT_FIELDS = ("channel_type", "whatsapp_instance", "instagram_instance")
+
+
+class TurnWriter:
+    """Unit of work for one chat turn.
+
+    `Ai Message` inserts, chat table rows and field updates are collected in
+    memory and written by `flush()`: one bulk insert per doctype, one update
+    per changed document and a single commit. Message names are generated up
+    front so rows can reference each other before they exist.
+
+    With "Chat Table" storage a message is only written as a row of its chat,
+    under the same name, and no `Ai Message` is created.
+    """
+
+    def __init__(self, storage=None):
+        self.chat_table = is_chat_table_storage(storage)
+        self.messages = {}
+        self.placed = set()
+        self.chat_rows = {}
+        self.updates = {}
+        self.started_at = time.perf_counter()
+        self.start_writes = get_write_count()
+
+    def new_message(self, chat, role, content, message_text=None, message_type="text", timestamp=None, **values) -> frappe._dict:
+        message = frappe._dict(
+            doctype="Ai Message",
+            name=frappe.generate_hash(length=10),
+            chat=getattr(chat, "name", chat),
+            role=role,
+            content=content,
+            message_text=message_text,
+            type=message_type,
+            timestamp=timestamp or now_datetime(),
+            responded_to=0,
+            response_type="Normal",
+        )
+        message.update(values)
+
+        self.messages[message.name] = message
+        return message
+
+    def append_chat_rows(self, chat_id, rows: list):
+        chat_rows = self.chat_rows.setdefault(chat_id, [])
+        for row in rows:
+            name = row.get("message")
+            if self.chat_table and name:
+                # The message itself becomes the row; one written earlier is a row already
+                if name in self.messages and name not in self.placed:
+                    self.placed.add(name)
+                    chat_rows.append(self.messages[name])
+                continue
+
+            chat_rows.append(row)
+
+    def touch(self, chat_id):
+        """Bump the chat's `modified` at flush time, even without new rows."""
+        self.chat_rows.setdefault(chat_id, [])
+
+    def set_value(self, doctype, name, values: dict):
+        """Update a document at flush time; pending messages are updated before insert."""
+        if doctype == "Ai Message" and name in self.messages:
+            self.messages[name].update(values)
+            return
+
+        if doctype == "Ai Message" and self.chat_table:
+            doctype = "Ai Messages Table"
+
+        self.updates.setdefault((doctype, name), {}).update(values)
+
+    def flush(self, commit=True) -> dict:
+        flush_started_at = time.perf_counter()
+
+        if self.chat_table:
+            # Messages not placed in the chat by the turn go after its rows
+            for name, message in self.messages.items():
+                if name not in self.placed:
+                    self.chat_rows.setdefault(message.chat, []).append(message)
+        elif self.messages:
+            self.insert_messages()
+
+        for chat_id, rows in self.chat_rows.items():
+            append_chat_messages(chat_id, [self.get_row(row) for row in rows])
+
+        for (doctype, name), values in self.updates.items():
+            frappe.db.set_value(doctype, name, values)
+
+        stats = {
+            "storage": CHAT_TABLE if self.chat_table else BOTH,
+            "messages": len(self.messages),
+            "chat_rows": sum(len(rows) for rows in self.chat_rows.values()),
+            "updates": len(self.updates),
+            "rows_written": sum(len(rows) for rows in self.chat_rows.values()) + (0 if self.chat_table else len(self.messages)),
+            "write_statements": max(get_write_count() - self.start_writes, 0),
+            "flush_ms": int((time.perf_counter() - flush_started_at) * 1000),
+            "turn_ms": int((time.perf_counter() - self.started_at) * 1000),
+        }
+
+        if commit:
+            frappe.db.commit()
+
+        self.messages = {}
+        self.placed = set()
+        self.chat_rows = {}
+        self.updates = {}
+
+        frappe.logger("ai_intergration").info({"event": "ai_turn_write", **stats})
+        return stats
+
+    def insert_messages(self):
+        now = now_datetime()
+        user = frappe.session.user
+
+        chats = {
+            c.name: c
+            for c in frappe.get_all(
+                "Ai Chat",
+                filters={"name": ["in", list({m.chat for m in self.messages.values()})]},
+                fields=["name", *CHAT_FIELDS],
+            )
+        }
+
+        values = []
+        for m in self.messages.values():
+            m.update({field: (chats.get(m.chat) or {}).get(field) for field in CHAT_FIELDS})
+            values.append([m.name, now, now, user, user] + [get_field_value(m, field) for field in MESSAGE_FIELDS])
+
+        frappe.db.bulk_insert(
+            "Ai Message",
+            ["name", "creation", "modified", "owner", "modified_by", *MESSAGE_FIELDS],
+            values,
+        )
+
+    def get_row(self, row) -> dict:
+        """`Ai Messages Table` row for a chat row or a pending `Ai Message`.
+
+        Rows linked to a message of this turn get its details, so the table
+        holds the whole conversation in either storage mode.
+        """
+        if row.get("doctype") == "Ai Message":
+            return {**row, "type": "message", "message_type": row.type}
+
+        message = self.messages.get(row.get("message"))
+        if not message:
+            return row
+
+        details = self.get_row(message)
+        details.pop("name")
+
+        return {**details, **row}
+
+
+def get_write_count() -> int:
+    # Frappe counts INSERT/UPDATE/DELETE statements of the open transaction
+    return getattr(frappe.db, "transaction_writes", 0)
+
+
+def begin_turn() -> TurnWriter:
+    frappe.local.ai_turn_writer = TurnWriter()
+    return frappe.local.ai_turn_writer
+
+
+def get_turn_writer():
+    return getattr(frappe.local, "ai_turn_writer", None)
+
+
+def end_turn(commit=True) -> dict:
+    writer = get_turn_writer()
+    if not writer:
+        return {}
+
+    frappe.local.ai_turn_writer = None
+    return writer.flush(commit=commit)
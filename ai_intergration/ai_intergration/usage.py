@@ -0,0 +1,188 @@
+import hashlib
+
+import frappe
+from frappe.utils import cint, getdate, now_datetime
+
+
+LOG_FIELDS = (
+    "timestamp",
+    "provider",
+    "model",
+    "agent",
+    "chat",
+    "client_credentials",
+    "input_tokens",
+    "cached_tokens",
+    "output_tokens",
+    "latency_ms",
+)
+
+COUNTERS = ("calls", "input_tokens", "cached_tokens", "output_tokens", "latency_ms")
+
+
+def set_usage_context(agent=None, chat=None, client_credentials=None):
+    """Tag the LLM calls made by the rest of this request or job."""
+    frappe.local.ai_usage_context = {
+        "agent": agent,
+        "chat": chat,
+        "client_credentials": client_credentials,
+    }
+
+
+def record_usage(provider, model, latency_ms, input_tokens=0, cached_tokens=0, output_tokens=0, **context):
+    """Buffer a usage record; it is written by a background job once the request ends."""
+    record = dict(getattr(frappe.local, "ai_usage_context", None) or {})
+    record.update({k: v for k, v in context.items() if v})
+    record.update({
+        "timestamp": now_datetime(),
+        "provider": provider,
+        "model": model,
+        "input_tokens": cint(input_tokens),
+        "cached_tokens": cint(cached_tokens),
+        "output_tokens": cint(output_tokens),
+        "latency_ms": cint(latency_ms),
+    })
+
+    if not hasattr(frappe.local, "ai_usage_records"):
+        frappe.local.ai_usage_records = []
+
+    frappe.local.ai_usage_records.append(record)
+
+
+def get_openai_usage(response) -> dict:
+    usage = getattr(response, "usage", None)
+    if not usage:
+        return {}
+
+    details = getattr(usage, "input_tokens_details", None)
+
+    return {
+        "input_tokens": usage.input_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", 0) if details else 0,
+        "output_tokens": usage.output_tokens,
+    }
+
+
+def get_ollama_usage(data) -> dict:
+    if not data:
+        return {}
+
+    return {
+        "input_tokens": data.get("prompt_eval_count") or 0,
+        "output_tokens": data.get("eval_count") or 0,
+    }
+
+
+def flush_usage():
+    """after_request / after_job hook: hand the buffered records to a background job."""
+    records = getattr(frappe.local, "ai_usage_records", None)
+    if not records:
+        return
+
+    frappe.local.ai_usage_records = []
+
+    try:
+        frappe.enqueue(
+            "ai_intergration.ai_intergration.usage.write_usage",
+            queue="short",
+            records=records,
+        )
+    except Exception:
+        frappe.log_error(title="AI usage records dropped")
+
+
+def write_usage(records):
+    now = now_datetime()
+    user = frappe.session.user
+
+    values = []
+    for record in records:
+        values.append(
+            [frappe.generate_hash(length=12), now, now, user, user]
+            + [record.get(field) for field in LOG_FIELDS]
+        )
+
+    frappe.db.bulk_insert(
+        "Ai Usage Log",
+        ["name", "creation", "modified", "owner", "modified_by", *LOG_FIELDS],
+        values,
+    )
+
+    for key, totals in get_rollups(records).items():
+        upsert_daily(key, totals, now, user)
+
+    frappe.db.commit()
+
+
+def get_rollups(records) -> dict:
+    rollups = {}
+    for record in records:
+        key = (getdate(record["timestamp"]), record.get("agent"), record["provider"], record["model"])
+        totals = rollups.setdefault(key, dict.fromkeys(COUNTERS, 0))
+
+        totals["calls"] += 1
+        for field in COUNTERS[1:]:
+            totals[field] += cint(record.get(field))
+
+    return rollups
+
+
+def upsert_daily(key, totals, now, user):
+    date, agent, provider, model = key
+    name = hashlib.md5("|".join(str(k or "") for k in key).encode()).hexdigest()[:16]
+
+    frappe.db.sql(
+        """
+        INSERT INTO `tabAi Usage Daily`
+            (name, creation, modified, owner, modified_by, date, agent, provider, model,
+            calls, input_tokens, cached_tokens, output_tokens, latency_ms)
+        VALUES
+            (%(name)s, %(now)s, %(now)s, %(user)s, %(user)s, %(date)s, %(agent)s, %(provider)s, %(model)s,
+            %(calls)s, %(input_tokens)s, %(cached_tokens)s, %(output_tokens)s, %(latency_ms)s)
+        ON DUPLICATE KEY UPDATE
+            modified = VALUES(modified),
+            calls = calls + VALUES(calls),
+            input_tokens = input_tokens + VALUES(input_tokens),
+            cached_tokens = cached_tokens + VALUES(cached_tokens),
+            output_tokens = output_tokens + VALUES(output_tokens),
+            latency_ms = latency_ms + VALUES(latency_ms)
+        """,
+        {
+            "name": name,
+            "now": now,
+            "user": user,
+            "date": date,
+            "agent": agent,
+            "provider": provider,
+            "model": model,
+            **totals,
+        },
+    )
+
+
+@frappe.whitelist()
+def get_usage_summary(from_date, to_date, agent=None, group_by="agent"):
+    """Token and latency totals per agent (or model / date) from the daily rollups."""
+    frappe.only_for("System Manager")
+
+    if group_by not in ("agent", "model", "date", "provider"):
+        frappe.throw("Invalid group_by")
+
+    filters = {"date": ["between", [from_date, to_date]]}
+    if agent:
+        filters["agent"] = agent
+
+    return frappe.get_all(
+        "Ai Usage Daily",
+        filters=filters,
+        fields=[
+            group_by,
+            "sum(calls) as calls",
+            "sum(input_tokens) as input_tokens",
+            "sum(cached_tokens) as cached_tokens",
+            "sum(output_tokens) as output_tokens",
+            "sum(latency_ms) / sum(calls) as avg_latency_ms",
+        ],
+        group_by=group_by,
+        order_by=f"{group_by} asc",
+    )
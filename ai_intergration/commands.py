@@ -0,0 +1,32 @@
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("ai-audit-queries")
+@click.option("--chats", default=200, help="Chats to seed")
+@click.option("--messages-per-chat", default=50, help="Messages seeded per chat")
+@pass_context
+def audit_queries(context, chats, messages_per_chat):
+	"""EXPLAIN the chat hot-path queries on seeded data and fail on full scans"""
+	import frappe
+
+	from ai_intergration.ai_intergration.query_audit import run_audit
+
+	site = get_site(context)
+	frappe.init(site=site)
+	frappe.connect()
+	try:
+		results = run_audit(chats, messages_per_chat)
+	finally:
+		frappe.destroy()
+
+	for r in results:
+		status = "ok" if r["passed"] else "FULL SCAN"
+		click.echo(f"{status:>9}  {r['query']:<42} type={r['type']} key={r['key']} rows={r['rows']} {r['extra'] or ''}")
+
+	if not all(r["passed"] for r in results):
+		click.secho("Some hot-path queries are not using an index", fg="red")
+		raise SystemExit(1)
+
+
+commands = [audit_queries]
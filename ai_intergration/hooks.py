@@ -124,6 +124,41 @@ app_license = "MIT"
 # 	}
 # }
 
+doc_events = {
+	# Documents of doctypes referenced by an AI Agent's reference targets
+	"*": {
+		"on_change": "ai_intergration.ai_intergration.reference_sync.on_document_change",
+		"on_trash": "ai_intergration.ai_intergration.reference_sync.on_document_change",
+		"after_rename": "ai_intergration.ai_intergration.reference_sync.on_document_change",
+	},
+	"Client Credentials": {
+		"on_update": "ai_intergration.ai_intergration.llm_clients.clear_clients",
+		"on_trash": "ai_intergration.ai_intergration.llm_clients.clear_clients",
+	},
+	"Ai Settings": {
+		"on_update": "ai_intergration.ai_intergration.llm_clients.clear_clients",
+	},
+	"AI Agent": {
+		"on_update": [
+			"ai_intergration.ai_intergration.context_sources.on_agent_update",
+			"ai_intergration.ai_intergration.reference_index.on_agent_update",
+			"ai_intergration.ai_intergration.reference_sync.on_agent_change",
+		],
+		"on_trash": [
+			"ai_intergration.ai_intergration.reference_index.on_agent_trash",
+			"ai_intergration.ai_intergration.reference_sync.on_agent_change",
+		],
+	},
+	"Ai Data Source Template": {
+		"on_update": "ai_intergration.ai_intergration.tool_catalog.recompile_template",
+		"on_trash": "ai_intergration.ai_intergration.tool_catalog.recompile_template",
+	},
+	"Ai Data Source": {
+		"on_update": "ai_intergration.ai_intergration.tool_catalog.recompile_source_templates",
+		"on_trash": "ai_intergration.ai_intergration.tool_catalog.recompile_source_templates",
+	},
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -145,6 +180,22 @@ app_license = "MIT"
 # 	],
 # }
 
+scheduler_events = {
+	"all": [
+		"ai_intergration.ai_intergration.context_sources.refresh_agent_contexts",
+		"ai_intergration.ai_intergration.reference_sync.sweep_changes",
+	],
+	"hourly": [
+		"ai_intergration.ai_intergration.speech.evict_tts_cache",
+		"ai_intergration.ai_intergration.images.evict_vision_cache",
+		"ai_intergration.ai_intergration.bulk_responses.resume_stale_runs",
+	],
+	"daily_long": [
+		"ai_intergration.ai_intergration.log_retention.purge_logs",
+		"ai_intergration.ai_intergration.reference_index.rebuild_indexes",
+	],
+}
+
 # Testing
 # -------
 
@@ -183,6 +234,15 @@ app_license = "MIT"
 # before_job = ["ai_intergration.utils.before_job"]
 # after_job = ["ai_intergration.utils.after_job"]
 
+after_request = [
+	"ai_intergration.ai_intergration.usage.flush_usage",
+	"ai_intergration.ai_intergration.diagnostics.flush_logs",
+]
+after_job = [
+	"ai_intergration.ai_intergration.usage.flush_usage",
+	"ai_intergration.ai_intergration.diagnostics.flush_logs",
+]
+
 # User Data Protection
 # --------------------
 
@@ -0,0 +1,16 @@
+import frappe
+
+
+# (doctype, fields, index name) for the lookups on the chat hot path
+INDEXES = (
+    ("Ai Messages Table", ["parent", "idx"], "parent_idx_index"),
+    ("Ai Message", ["chat", "channel_type", "whatsapp_instance"], "chat_whatsapp_index"),
+    ("Ai Message", ["chat", "channel_type", "instagram_instance"], "chat_instagram_index"),
+    ("Ai Chat", ["phone_id", "whatsapp_instance"], "phone_whatsapp_index"),
+    ("Ai Chat", ["user_id", "instagram_instance"], "user_instagram_index"),
+)
+
+
+def execute():
+    for doctype, fields, index_name in INDEXES:
+        frappe.db.add_index(doctype, fields, index_name=index_name)
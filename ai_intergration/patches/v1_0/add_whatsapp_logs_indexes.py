@@ -0,0 +1,29 @@
+import frappe
+
+
+BATCH_SIZE = 10000
+
+
+def execute():
+    """Index `WhatsApp Logs` on what retention and the desk filter by.
+
+    Rows written before `timestamp` existed then get their creation time, so
+    the retention job reaches them through the index.
+    """
+    frappe.db.add_index("WhatsApp Logs", ["timestamp"], index_name="timestamp_index")
+    frappe.db.add_index("WhatsApp Logs", ["is_error", "timestamp"], index_name="is_error_timestamp_index")
+
+    while True:
+        frappe.db.sql(
+            """
+            UPDATE `tabWhatsApp Logs`
+            SET `timestamp` = creation
+            WHERE `timestamp` IS NULL
+            LIMIT %s
+            """,
+            BATCH_SIZE,
+        )
+        frappe.db.commit()
+
+        if not frappe.db.sql("SELECT name FROM `tabWhatsApp Logs` WHERE `timestamp` IS NULL LIMIT 1"):
+            break
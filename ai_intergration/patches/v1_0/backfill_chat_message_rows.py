@@ -0,0 +1,100 @@
+import frappe
+
+
+CHAT_BATCH_SIZE = 200
+
+# How far ahead a message is looked for among the chat's rows
+MATCH_WINDOW = 20
+
+DETAIL_FIELDS = (
+    "timestamp",
+    "image",
+    "whatsapp_message_id",
+    "responded_to",
+    "response_type",
+    "first_token_ms",
+    "response_ms",
+)
+
+
+def execute():
+    """Copy `Ai Message` details onto the chat rows.
+
+    Chats are processed in batches, with a commit after each. `Ai Message`
+    documents are left in place and `message_storage` is not changed: the
+    backfill only makes switching to "Chat Table" possible without losing
+    details.
+    """
+    last_chat = ""
+    while True:
+        chats = frappe.get_all(
+            "Ai Chat",
+            filters={"name": [">", last_chat]},
+            order_by="name asc",
+            limit=CHAT_BATCH_SIZE,
+            pluck="name",
+        )
+        if not chats:
+            break
+
+        for chat in chats:
+            backfill_chat(chat)
+
+        frappe.db.commit()
+        last_chat = chats[-1]
+
+
+def backfill_chat(chat):
+    messages = frappe.get_all(
+        "Ai Message",
+        filters={"chat": chat},
+        fields=["name", "role", "content", "type", *DETAIL_FIELDS],
+        order_by="creation asc",
+    )
+    if not messages:
+        return
+
+    rows = frappe.get_all(
+        "Ai Messages Table",
+        filters={"parent": chat, "parenttype": "Ai Chat", "call_id": ["is", "not set"]},
+        fields=["name", "message", "role", "content"],
+        order_by="idx asc",
+    )
+
+    for row, message in match_rows(rows, messages):
+        values = {field: message.get(field) for field in DETAIL_FIELDS}
+        values.update({
+            "message": message.name,
+            "message_type": message.type or "text",
+            "type": "message",
+        })
+
+        frappe.db.set_value("Ai Messages Table", row.name, values, update_modified=False)
+
+
+def match_rows(rows, messages) -> list:
+    """Pair chat rows with the messages they were copied from.
+
+    Rows are linked to their message since turns are written in one go;
+    older rows are matched in order on role and content. Messages that never
+    got a row (live chat messages, for example) are skipped.
+    """
+    by_name = {m.name: m for m in messages}
+    pairs = []
+    unlinked = []
+    for row in rows:
+        if row.message in by_name:
+            pairs.append((row, by_name.pop(row.message)))
+        elif not row.message:
+            unlinked.append(row)
+
+    position = 0
+    for message in (m for m in messages if m.name in by_name):
+        for i in range(position, min(position + MATCH_WINDOW, len(unlinked))):
+            row = unlinked[i]
+            if row.role == message.role and row.content == message.content:
+                pairs.append((row, message))
+                position = i + 1
+                break
+
+    return pairs
@@ -0,0 +1,12 @@
+import frappe
+
+
+def execute():
+    """Reference targets filtered before `filter_operator` existed matched with LIKE '%value%'; keep that."""
+    frappe.db.sql(
+        """
+        UPDATE `tabReference Targets Table`
+        SET filter_operator = 'Contains'
+        WHERE IFNULL(filter_fields, '') != ''
+        """
+    )